@@ -0,0 +1,61 @@
+"""Module for BackgroundTask class."""
+
+import queue
+import threading
+import traceback
+
+
+class BackgroundTask():
+    """Class for running long jobs out of Tk main loop.
+
+    Job is run in worker thread, its result is passed to callback in Tk
+    thread (by polling with root.after). Only the latest started job matters:
+    job receives is_stale function and should stop early, when it returns
+    True; results of stale jobs (and None-results of failed or interrupted
+    jobs) are dropped.
+    """
+
+    __POLL_MS = 50
+
+    __root = None
+    __callback = None
+    __generation = 0
+    __results = None
+    __polling = False
+
+    def __init__(self, root, callback):
+        """."""
+        self.__root = root
+        self.__callback = callback
+        self.__results = queue.Queue()
+
+    def start(self, job):
+        """Start job(is_stale) in worker thread."""
+        self.__generation += 1
+        generation = self.__generation
+
+        def is_stale():
+            return generation != self.__generation
+
+        def run():
+            result = None
+            try:
+                result = job(is_stale)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+            self.__results.put((generation, result))
+
+        threading.Thread(target=run, daemon=True).start()
+        if not self.__polling:
+            self.__polling = True
+            self.__root.after(self.__POLL_MS, self.__poll)
+
+    def __poll(self):
+        while not self.__results.empty():
+            generation, result = self.__results.get()
+            if generation == self.__generation:
+                self.__polling = False
+                if result is not None:
+                    self.__callback(result)
+                return
+        self.__root.after(self.__POLL_MS, self.__poll)
@@ -4,9 +4,15 @@ import os
 import json
 import copy
 import shutil
+import hashlib
 import pathlib
+import threading
+import numpy as np
 from PIL import Image
 from mark import deserialize_mark
+from packedfragments import PackedFragmentWriter
+from leasemanager import LeaseManager
+from fingerprintstore import FingerprintStore
 import utils
 
 
@@ -17,28 +23,83 @@ class DatasetManager():
     - search of unmarked image;
     - loading of unmarked images;
     - saving of marked image.
+
+    Several sessions (annotators) can work with the same dataset folder:
+    unmarked images are distributed between them by leases (see
+    LeaseManager), and saving detects labels changed by other sessions.
+
+    Catalog of images is built in background thread: until it is ready only
+    the first image of folder is available as current one (see get_current).
+
+    Fragments of labelled marks are kept in FingerprintStore, which is
+    synchronized with labels by their hashes, so source images are decoded
+    only for new or changed labels.
     """
 
     __FRAGM_WIDTH = 50
+    __PACK_CHUNK = 256
+    __LEASE_BATCH = 20
+    __DESCR_THRESHOLD = 0.3  # similarity of candidates for template matching
 
     __folder_dir = None
     __images_dir = None
     __labels_dir = None
     __current_index = 0
     __stems = []
+    __stem_indices = {}
+    __lease_m = None
+    __loaded_label_hashes = {}
+    __catalog_lock = None
+    __catalog_thread = None
+    __fingerprints = None
+    __current_img = None
 
-    def __init__(self, ds_folder_path):
+    def __init__(self, ds_folder_path, session_id=None):
         """."""
         self.__folder_dir = ds_folder_path
         self.__images_dir = ds_folder_path / 'images'
         self.__labels_dir = ds_folder_path / 'labels'
+        self.__stems = self.__get_first_stems()
+        self.__stem_indices = {s: k for k, s in enumerate(self.__stems)}
+        self.__current_index = 0
+        self.__loaded_label_hashes = {}
+        self.__lease_m = LeaseManager(ds_folder_path / 'leases', session_id)
+        self.__fingerprints = FingerprintStore(ds_folder_path / 'fingerprints')
+        self.__current_img = None
+        self.__catalog_lock = threading.Lock()
+        self.__catalog_thread = threading.Thread(target=self.__build_catalog,
+                                                 daemon=True)
+        self.__catalog_thread.start()
+
+    def __get_first_stems(self):
+        with os.scandir(self.__images_dir) as entries:
+            for entry in entries:
+                return [str(pathlib.Path(entry.name).stem)]
+        return []
+
+    def __build_catalog(self):
         names = os.listdir(self.__images_dir)
-        self.__stems = list(map(lambda n: str(pathlib.Path(n).stem), names))
-        if self.__stems:
-            self.__current_index = 0
+        stems = list(map(lambda n: str(pathlib.Path(n).stem), names))
+        stem_indices = {s: k for k, s in enumerate(stems)}
+        with self.__catalog_lock:
+            index = 0
+            if self.__stems:
+                current = self.__stems[self.__current_index]
+                index = stem_indices.get(current, 0)
+            self.__stems = stems
+            self.__stem_indices = stem_indices
+            self.__current_index = index
+
+    def __wait_catalog(self):
+        self.__catalog_thread.join()
+
+    def __snapshot(self):
+        with self.__catalog_lock:
+            return self.__stems, self.__current_index
 
     def move_forward(self):
         """."""
+        self.__wait_catalog()
         if self.__current_index == len(self.__stems) - 1:
             return False
         else:
@@ -47,21 +108,37 @@ class DatasetManager():
 
     def move_backward(self):
         """."""
+        self.__wait_catalog()
         if self.__current_index == 0:
             return False
         else:
             self.__current_index -= 1
             return True
 
+    def __label_path(self, stem):
+        return self.__labels_dir / (stem + '.json')
+
     def __get_index_of_first_unmarked(self):
-        for k, stem in enumerate(self.__stems):
-            label_path = self.__labels_dir / (stem + '.json')
-            if not label_path.exists():
-                return k
-        return None
+        lm = self.__lease_m
+        for stem in lm.owned_stems():
+            if self.__label_path(stem).exists():
+                lm.release(stem)
+        if not lm.owned_stems():
+            unmarked = (s for s in self.__stems
+                        if not self.__label_path(s).exists())
+            lm.claim(unmarked, self.__LEASE_BATCH)
+        owned = lm.owned_stems()
+        if not owned:
+            return None
+        return min(map(lambda s: self.__stem_indices[s], owned))
 
     def move_to_first_unmarked(self):
-        """Find first unmarked image in dataset and set it as current."""
+        """Find first unmarked image leased by this session, set it current.
+
+        If all leased images are marked, new batch of unmarked images, which
+        are not leased by other sessions, is claimed.
+        """
+        self.__wait_catalog()
         index = self.__get_index_of_first_unmarked()
         if index is None or index == self.__current_index:
             return False
@@ -69,8 +146,7 @@ class DatasetManager():
             self.__current_index = index
             return True
 
-    def __get_data(self, index):
-        stem = self.__stems[index]
+    def __get_data(self, stem):
         image_path = self.__images_dir / (stem + '.jpg')
         label_path = self.__labels_dir / (stem + '.json')
 
@@ -78,42 +154,136 @@ class DatasetManager():
         img.load()
 
         label = None
+        self.__loaded_label_hashes[stem] = self.__label_hash(stem)
         if label_path.exists():
             with open(label_path) as file:
                 label = json.load(file)
         return image_path.name, img, label
 
+    def __label_hash(self, stem):
+        try:
+            with open(self.__label_path(stem), mode='rb') as file:
+                return hashlib.sha1(file.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def has_save_conflict(self):
+        """Check if label of current image can't be saved without conflict.
+
+        Conflict: label was changed by another session after it was loaded
+        here, or image is leased by another session now.
+        """
+        self.__wait_catalog()
+        stem = self.__stems[self.__current_index]
+        if stem in self.__loaded_label_hashes:
+            if self.__label_hash(stem) != self.__loaded_label_hashes[stem]:
+                return True
+        return self.__lease_m.is_leased_by_other(stem)
+
+    def heartbeat(self):
+        """Prolong leases of this session, should be called periodically."""
+        self.__lease_m.heartbeat()
+
+    def close(self):
+        """Release all leases of this session."""
+        self.__lease_m.release_all()
+
     def get_current(self):
-        """."""
-        return self.__get_data(self.__current_index)
-
-    def get_last(self, num=400):
-        """Return n previous images and marks before current."""
-        result = []
-        if self.__current_index is None:
-            return result
-        begin_idx = max(self.__current_index + 1 - num, 0)
-        end_idx = self.__current_index + 1
-        prev_range = range(begin_idx, end_idx)
-        for k in prev_range:
-            result.append(self.__get_data(k))
-        return result
-
-    def save_marks_in_label(self, label):
-        """Save marks in json-file."""
+        """Return current image and marks, doesn't wait for catalog."""
+        stems, index = self.__snapshot()
+        data = self.__get_data(stems[index])
+        self.__current_img = (stems[index], data[1])
+        return data
+
+    def __sync_fingerprints(self, stem, img=None):
+        """Update fingerprints of stem, if its label was changed.
+
+        Return marks and hash of label (None, if there is no label) and image
+        (None, if it wasn't needed).
+        """
+        store = self.__fingerprints
+        try:
+            with open(self.__label_path(stem), mode='rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            store.remove(stem)
+            return None, None, img
+        label_hash = hashlib.sha1(data).hexdigest()
+        marks = list(map(deserialize_mark, json.loads(data)['marks']))
+        if store.label_hash(stem) != label_hash:
+            if img is None:
+                img = self.__load_image(stem)
+            if not store.update(stem, label_hash, marks, img):
+                print('Fingerprint store is busy, {} is not stored'.format(
+                    stem))
+        return marks, label_hash, img
+
+    def __load_image(self, stem):
+        img = Image.open(str(self.__images_dir / (stem + '.jpg')))
+        img.load()
+        return img
+
+    def get_fingerprints(self, stem):
+        """Return list of (mark, grey fragment, descriptor, inside).
+
+        If store can't be updated (it's locked by another session), fragments
+        are cropped from image without storing.
+        """
+        marks, label_hash, img = self.__sync_fingerprints(stem)
+        if not marks:
+            return []
+        store = self.__fingerprints
+        rows = store.get(stem, label_hash)
+        if len(rows) != len(marks):
+            if img is None:
+                img = self.__load_image(stem)
+            rows = store.compute(marks, img)
+        return [(m,) + row for m, row in zip(marks, rows)]
+
+    def iter_last_fingerprints(self, num=400):
+        """Iterate over fingerprints of n previous images before current.
+
+        Yields list of fingerprints (see get_fingerprints) for each image.
+        """
+        self.__wait_catalog()
+        stems, index = self.__snapshot()
+        begin_idx = max(index + 1 - num, 0)
+        for stem in stems[begin_idx:index]:
+            yield self.get_fingerprints(stem)
+
+    def save_marks_in_label(self, label, force=False):
+        """Save marks in json-file.
+
+        Return False (and don't save), if there is conflict with another
+        session and force is False.
+        """
+        self.__wait_catalog()
+        if not force and self.has_save_conflict():
+            return False
         stem = self.__stems[self.__current_index]
-        label_path = self.__labels_dir / (stem + '.json')
-        if label_path.exists():
-            os.remove(label_path)
-        with open(label_path, mode='w') as file:
+        label_path = self.__label_path(stem)
+        tmp_path = label_path.with_name(
+            label_path.name + '.' + self.__lease_m.session_id())
+        with open(tmp_path, mode='w') as file:
             json.dump(label, file, indent=' '*4)
+        os.replace(tmp_path, label_path)
+        self.__loaded_label_hashes[stem] = self.__label_hash(stem)
+        img = None
+        if self.__current_img and self.__current_img[0] == stem:
+            img = self.__current_img[1]
+        self.__sync_fingerprints(stem, img)
+        self.__lease_m.release(stem)
+        return True
 
     def remove_label(self):
         """Remove label file for current_image."""
+        self.__wait_catalog()
         stem = self.__stems[self.__current_index]
-        label_path = self.__labels_dir / (stem + '.json')
+        label_path = self.__label_path(stem)
         if label_path.exists():
             os.remove(label_path)
+            self.__loaded_label_hashes[stem] = None
+            self.__fingerprints.remove(stem)
             return True
         else:
             return False
@@ -123,55 +293,74 @@ class DatasetManager():
         str_index = str(index)
         return '0' * (CHAR_NUM - len(str_index)) + str_index
 
-    def __is_rect_inside_img(self, img_size, rect):
-        w, h = img_size
-        return rect[0] >= 0 and rect[1] >= 0 and rect[2] < w and rect[3] < h
-
-    def __save_fragment_dataset(self, fragments, marks):
+    def __create_fragment_ds_dir(self, packed):
+        """Recreate folder of fragment dataset, return packed writer."""
+        if packed:
+            fr_ds_dir = self.__folder_dir / 'fragm_ds_packed'
+            if fr_ds_dir.exists():
+                shutil.rmtree(fr_ds_dir)
+            return PackedFragmentWriter(fr_ds_dir, self.__FRAGM_WIDTH)
         fr_ds_dir = self.__folder_dir / 'fragm_ds'
-        fr_ds_images_dir = fr_ds_dir / 'images'
-        fr_ds_labels_dir = fr_ds_dir / 'labels'
         if fr_ds_dir.exists():
             shutil.rmtree(fr_ds_dir)
         os.mkdir(fr_ds_dir)
-        os.mkdir(fr_ds_images_dir)
-        os.mkdir(fr_ds_labels_dir)
-
-        for i, fragm in enumerate(fragments):
-            mark = marks[i]
-            stem = self.__create_stem(i)
-            fragm_path = fr_ds_images_dir / (stem + '.png')
-            label_path = fr_ds_labels_dir / (stem + '.json')
-            label = {'filename':  stem + '.png', 'mark': mark.serialized()}
-            with open(label_path, mode='w') as file:
-                json.dump(label, file, indent=' '*4)
-            fragm.save(fragm_path)
-
-    def __has_matches(self, fragments, fragm):
-        FW = self.__FRAGM_WIDTH
-        INDENT = 5
-        THRESHOLD = 0.99
-        center_part = fragm.crop([INDENT, INDENT, FW - INDENT, FW - INDENT])
-        for f in fragments:
-            rects = utils.find_matches(f, center_part, THRESHOLD)
-            if rects:
-                return True
-        return False
+        os.mkdir(fr_ds_dir / 'images')
+        os.mkdir(fr_ds_dir / 'labels')
+        return None
 
-    def create_fragment_ds(self):
-        """Create fragment dataset from current dataset.
+    def __save_fragment(self, index, fragm, mark):
+        fr_ds_dir = self.__folder_dir / 'fragm_ds'
+        stem = self.__create_stem(index)
+        fragm_path = fr_ds_dir / 'images' / (stem + '.png')
+        label_path = fr_ds_dir / 'labels' / (stem + '.json')
+        label = {'filename':  stem + '.png', 'mark': mark.serialized()}
+        with open(label_path, mode='w') as file:
+            json.dump(label, file, indent=' '*4)
+        fragm.save(fragm_path)
 
-        Result: cropped fragments with exactly one mark for each fragment.
-        Fragment dataset will be saved in the folder of initial dataset.
+    def __select_unique(self, fingerprints):
+        """Return indices of fingerprints, which don't match previous ones.
+
+        Deduplication is approximate: fingerprints are compared by
+        descriptors first, and only similar ones (DESCR_THRESHOLD) are
+        compared by template matching. So some duplicates, shifted by a few
+        pixels, are kept (below 1% of ones found by template matching
+        alone on test images).
         """
-        print('Fragments dataset extraction started.')
-        ds_fragments = []
-        ds_marks = []
-        label_names = os.listdir(self.__labels_dir)
-        label_paths = list(map(lambda x: self.__labels_dir / x, label_names))
-        for k, l_path in enumerate(label_paths):
-            if k % int(round(len(label_paths) / 20)) == 0:
+        INDENT = 5
+        THRESHOLD = 0.99
+        selected = []
+        if not fingerprints:
+            return selected
+        descrs = np.empty((len(fingerprints), len(fingerprints[0][3])),
+                          dtype=np.float32)
+        for k, (_, _, fragm, descr) in enumerate(fingerprints):
+            center_part = fragm[INDENT:-INDENT, INDENT:-INDENT]
+            sims = descrs[:len(selected)] @ descr
+            candidates = np.nonzero(sims > self.__DESCR_THRESHOLD)[0]
+            if any(utils.find_matches(fingerprints[selected[c]][2],
+                                      center_part, THRESHOLD)
+                   for c in candidates):
+                continue
+            descrs[len(selected)] = descr
+            selected.append(k)
+        return selected
+
+    def __iter_labeled_stems(self, progress=False):
+        label_names = [n for n in os.listdir(self.__labels_dir)
+                       if n.endswith('.json')]
+        dot_step = max(int(round(len(label_names) / 20)), 1)
+        for k, name in enumerate(label_names):
+            if progress and k % dot_step == 0:
                 print('. ', end='')
+            yield str(pathlib.Path(name).stem)
+        if progress:
+            print()  # for a new line after dot-bar
+
+    def __iter_labeled_images(self):
+        """Iterate over images with marks as (image path, image, marks)."""
+        for stem in self.__iter_labeled_stems():
+            l_path = self.__label_path(stem)
             if not l_path.exists():
                 continue
             label = None
@@ -180,24 +369,74 @@ class DatasetManager():
             marks = list(map(deserialize_mark, label['marks']))
             if not marks:
                 continue
-            FW = self.__FRAGM_WIDTH
-            img_path = self.__images_dir / label['filename']
+            img_path = self.__images_dir / (stem + '.jpg')
             img = Image.open(str(img_path))
             img.load()
-            for m in marks:
-                crop_rect = [m.cx - FW / 2, m.cy - FW / 2,
-                             m.cx + FW / 2, m.cy + FW / 2]
-                if not self.__is_rect_inside_img(img.size, crop_rect):
-                    continue
-                fragm = img.crop(crop_rect)
-                if self.__has_matches(ds_fragments, fragm):
-                    continue
-                fr_mark = copy.deepcopy(m)
-                fr_mark.cx, fr_mark.cy = FW / 2, FW / 2
-                ds_fragments.append(fragm)
-                ds_marks.append(fr_mark)
-        print()  # for a new line after dot-bar
-
-        if ds_fragments:
-            self.__save_fragment_dataset(ds_fragments, ds_marks)
+            yield img_path, img, marks
+
+    def iter_normalized_fragments(self, extractor=None):
+        """Iterate over rotation-normalized fragments of all marks.
+
+        Fragments aren't saved anywhere, so this generator can feed training
+        directly. Yields (fragments, fragment_mark, image name) for each
+        marked image, fragments - (N, H, W, 3) uint8 array, one per mark
+        (marks near image border aren't dropped, see FragmentExtractor).
+        """
+        if extractor is None:
+            # it imports cv2, see utils.find_matches
+            # pylint: disable=import-outside-toplevel
+            from fragmentextractor import FragmentExtractor
+            extractor = FragmentExtractor()
+        fr_mark = extractor.fragment_mark()
+        for img_path, img, marks in self.__iter_labeled_images():
+            yield extractor.extract(img, marks), fr_mark, img_path.name
+
+    def create_fragment_ds(self, packed=False):
+        """Create fragment dataset from current dataset.
+
+        Result: cropped fragments with exactly one mark for each fragment.
+        Fragment dataset will be saved in the folder of initial dataset:
+        as separate png- and json-files in 'fragm_ds' or, if packed is True,
+        as memory-mappable arrays in 'fragm_ds_packed' (see packedfragments).
+        Duplicates of fragments are removed approximately (see
+        __select_unique).
+        """
+        print('Fragments dataset extraction started.')
+        fingerprints = []
+        for stem in self.__iter_labeled_stems(progress=True):
+            for m, fragm, descr, inside in self.get_fingerprints(stem):
+                if inside:
+                    fingerprints.append((stem, m, fragm, descr))
+        selected = self.__select_unique(fingerprints)
+
+        if not selected:
+            print('Fragments dataset extraction finished.')
+            return
+
+        # only images with selected fragments are decoded (for color),
+        # fragments are written as soon as they are cropped
+        writer = self.__create_fragment_ds_dir(packed)
+        chunk = ([], [], [])
+        FW = self.__FRAGM_WIDTH
+        img, img_stem = None, None
+        for i, k in enumerate(selected):
+            stem, m, _, _ = fingerprints[k]
+            if stem != img_stem:
+                img = self.__load_image(stem)
+                img_stem = stem
+            crop_rect = [m.cx - FW / 2, m.cy - FW / 2,
+                         m.cx + FW / 2, m.cy + FW / 2]
+            fragm = img.crop(crop_rect)
+            fr_mark = copy.deepcopy(m)
+            fr_mark.cx, fr_mark.cy = FW / 2, FW / 2
+            if writer is None:
+                self.__save_fragment(i, fragm, fr_mark)
+                continue
+            for column, value in zip(chunk, (fragm, fr_mark, stem + '.jpg')):
+                column.append(value)
+            if len(chunk[0]) == self.__PACK_CHUNK:
+                writer.append(*chunk)
+                chunk = ([], [], [])
+        if writer is not None:
+            writer.append(*chunk)
         print('Fragments dataset extraction finished.')
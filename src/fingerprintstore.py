@@ -0,0 +1,405 @@
+"""Module for FingerprintStore class.
+
+Fingerprint store is a folder next to 'labels' of dataset with files:
+- fragments.<R>.u8 - raw uint8 array of shape (N, FW, FW): greyscale
+  fragments around centers of marks (parts outside of image are black, as
+  PIL crops);
+- descriptors.<R>.f32 - raw float32 array of shape (N, DS * DS): thumbnails
+  of fragments with zero mean and unit norm, for fast search of similar ones;
+- inside.<R>.u8 - raw uint8 array of shape (N,): 1 if fragment is entirely
+  inside of image;
+- snapshot.<G>.bin - records of all stored labels, sorted by stem;
+- journal.<G>.bin - records written after snapshot;
+- store.json - current generation G of snapshot and journal, generation R of
+  row files and counters of rows, e.g.:
+  {"generation": 3, "rows_generation": 2, "rows": 5120, "live_rows": 4800}
+
+Snapshot and journal consist of fixed-width records (see RECORD_DTYPE):
+record assigns rows [start, start + count) to marks of label of stem with
+given hash (in order of marks in label, marks themselves are read from
+label). Journal record with empty hash means that label was removed. So
+reopening of store only maps the snapshot and reads short journal tail, and
+stem is found in snapshot by binary search.
+
+Row files and journal are only appended, rows of replaced labels just
+become unused. When unused rows become too many, or journal becomes too
+long, store is compacted: live rows (or only records) are rewritten into
+files of next generation, store.json is replaced and files of previous
+generations are removed (if they are still mapped by other sessions on
+Windows - on the next compaction or reopening). Writes are guarded by
+lock-file, so several sessions can share the store: each of them reads
+store.json and new journal records before any access, and reopens files, if
+generation was changed.
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from PIL import Image
+
+META_FILE = 'store.json'
+LOCK_FILE = 'store.lock'
+RECORD_DTYPE = np.dtype([('stem', 'S64'), ('hash', 'S40'),
+                         ('start', '<i8'), ('count', '<i4')])
+
+
+def crop_grey_fragment(grey_img, mark, width):
+    """Crop square greyscale fragment around mark center as array."""
+    m = mark
+    crop_rect = [m.cx - width / 2, m.cy - width / 2,
+                 m.cx + width / 2, m.cy + width / 2]
+    return np.asarray(grey_img.crop(crop_rect), dtype=np.uint8)
+
+
+class FingerprintStore():
+    """Class for persistent storage of fragments of labelled marks.
+
+    Fragments are returned as views of read-only np.memmap, so reopening
+    of store and access to fragments don't decode or crop source images.
+    """
+
+    __FRAGM_W = 50
+    __DESCR_SZ = 8
+    __LOCK_TIMEOUT_SEC = 5
+    __STALE_LOCK_SEC = 60
+    __COMPACT_MIN_ROWS = 1024
+    __COMPACT_UNUSED = 0.5  # part of unused rows, which triggers compaction
+    __JOURNAL_MAX = 4096  # number of journal records, merged into snapshot
+    __COPY_CHUNK = 4096
+
+    __folder_dir = None
+    __lock = None
+    __meta = None
+    __snapshot = None
+    __tail = {}
+    __journal_offset = 0
+    __rows = 0
+    __live_rows = 0
+    __arrays = None
+    __mapped_rows = 0
+
+    def __init__(self, folder_path):
+        """."""
+        self.__folder_dir = folder_path
+        os.makedirs(self.__folder_dir, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__meta = None
+        self.__tail = {}
+        with self.__lock:
+            self.__refresh()
+            self.__remove_old_generations()
+
+    def __read_meta(self):
+        try:
+            with open(self.__folder_dir / META_FILE) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'generation': 0, 'rows_generation': 0, 'rows': 0,
+                    'live_rows': 0}
+
+    def __path(self, name, meta=None):
+        """Return path of file of current (or given by meta) generation."""
+        meta = meta or self.__meta
+        if name in ('snapshot', 'journal'):
+            return self.__folder_dir / '{}.{}.bin'.format(
+                name, meta['generation'])
+        ext = {'fragments': 'u8', 'descriptors': 'f32', 'inside': 'u8'}
+        return self.__folder_dir / '{}.{}.{}'.format(
+            name, meta['rows_generation'], ext[name])
+
+    def __open_generation(self, meta):
+        self.__meta = meta
+        self.__tail = {}
+        self.__journal_offset = 0
+        self.__rows = meta['rows']
+        self.__live_rows = meta['live_rows']
+        self.__arrays = None
+        self.__mapped_rows = 0
+        path = self.__path('snapshot')
+        if path.exists() and path.stat().st_size > 0:
+            self.__snapshot = np.memmap(path, dtype=RECORD_DTYPE, mode='r')
+        else:
+            self.__snapshot = np.empty((0,), dtype=RECORD_DTYPE)
+
+    def __refresh(self):
+        """Read journal records written since last refresh."""
+        while True:
+            meta = self.__read_meta()
+            if self.__meta is None or \
+                    meta['generation'] != self.__meta['generation']:
+                self.__open_generation(meta)
+            try:
+                with open(self.__path('journal'), mode='rb') as file:
+                    file.seek(self.__journal_offset)
+                    data = file.read()
+                break
+            except FileNotFoundError:
+                if self.__meta == self.__read_meta():
+                    return  # journal is empty yet
+                # store was compacted by another session meanwhile
+        n = len(data) // RECORD_DTYPE.itemsize  # last one can be incomplete
+        records = np.frombuffer(data, dtype=RECORD_DTYPE, count=n)
+        for rec in records:
+            stem = rec['stem'].decode()
+            old = self.__find(stem)
+            if old:
+                self.__live_rows -= old[2]
+            if rec['hash']:
+                record = (rec['hash'].decode(), int(rec['start']),
+                          int(rec['count']))
+                self.__live_rows += record[2]
+                self.__rows = max(self.__rows, record[1] + record[2])
+            else:
+                record = None
+            self.__tail[stem] = record
+        self.__journal_offset += n * RECORD_DTYPE.itemsize
+
+    def __find(self, stem):
+        """Return (hash, start, count) of stem or None."""
+        if stem in self.__tail:
+            return self.__tail[stem]
+        stems = self.__snapshot['stem']
+        key = stem.encode()
+        idx = int(np.searchsorted(stems, key))
+        if idx < len(stems) and stems[idx] == key:
+            rec = self.__snapshot[idx]
+            return rec['hash'].decode(), int(rec['start']), int(rec['count'])
+        return None
+
+    def __acquire_file_lock(self):
+        lock_path = self.__folder_dir / LOCK_FILE
+        deadline = time.time() + self.__LOCK_TIMEOUT_SEC
+        while True:
+            try:
+                os.close(os.open(lock_path,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.path.getmtime(lock_path) > \
+                        self.__STALE_LOCK_SEC:
+                    os.remove(lock_path)  # left by killed session
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+
+    def __release_file_lock(self):
+        os.remove(self.__folder_dir / LOCK_FILE)
+
+    def __row_formats(self):
+        FW, DS = self.__FRAGM_W, self.__DESCR_SZ
+        return [('fragments', np.uint8, (FW, FW)),
+                ('descriptors', np.float32, (DS * DS,)),
+                ('inside', np.uint8, ())]
+
+    def __append(self, stem, label_hash, rows_data, count):
+        """Append rows and journal record, return False if store is busy."""
+        if len(stem.encode()) > RECORD_DTYPE['stem'].itemsize:
+            raise ValueError('Too long stem: ' + stem)
+        if not self.__acquire_file_lock():
+            return False
+        try:
+            self.__refresh()
+            start = self.__rows
+            for (name, dtype, shape), data in zip(self.__row_formats(),
+                                                  rows_data):
+                row_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                fd = os.open(self.__path(name), os.O_RDWR | os.O_CREAT)
+                with os.fdopen(fd, mode='r+b') as file:
+                    # tail of interrupted append is overwritten, not
+                    # truncated: file can't be shrunk on Windows, while
+                    # it's mapped (by this or another session)
+                    file.seek(start * row_size)
+                    file.write(data)
+            record = np.array([(stem.encode(), (label_hash or '').encode(),
+                                start, count)], dtype=RECORD_DTYPE)
+            with open(self.__path('journal'), mode='ab') as file:
+                if file.tell() != self.__journal_offset:
+                    file.truncate(self.__journal_offset)
+                file.write(record.tobytes())
+            self.__refresh()
+            if self.__rows >= self.__COMPACT_MIN_ROWS and \
+                    self.__rows - self.__live_rows > \
+                    self.__rows * self.__COMPACT_UNUSED:
+                self.__compact(compact_rows=True)
+            elif len(self.__tail) > self.__JOURNAL_MAX:
+                self.__compact(compact_rows=False)
+        finally:
+            self.__release_file_lock()
+        return True
+
+    def __live_records(self):
+        """Return sorted array of records of all stored labels."""
+        snapshot = np.asarray(self.__snapshot)
+        if self.__tail:
+            tail_stems = np.array(list(map(str.encode, self.__tail)),
+                                  dtype=RECORD_DTYPE['stem'])
+            snapshot = snapshot[~np.isin(snapshot['stem'], tail_stems)]
+        tail = np.array([(stem.encode(), rec[0].encode(), rec[1], rec[2])
+                         for stem, rec in self.__tail.items() if rec],
+                        dtype=RECORD_DTYPE)
+        records = np.concatenate([snapshot, tail])
+        records.sort(order='stem')
+        return records
+
+    def __compact(self, compact_rows):
+        """Write snapshot (and live rows) of next generation.
+
+        Must be called under file lock right after refresh.
+        """
+        records = self.__live_records()
+        meta = dict(self.__meta)
+        meta['generation'] += 1
+        meta['live_rows'] = int(records['count'].sum())
+        if compact_rows:
+            meta['rows_generation'] = meta['generation']
+            counts = records['count'].astype(np.int64)
+            new_starts = np.cumsum(counts) - counts
+            rows_idx = np.repeat(records['start'] - new_starts, counts) + \
+                np.arange(meta['live_rows'], dtype=np.int64)
+            for name, dtype, shape in self.__row_formats():
+                old = np.memmap(self.__path(name), dtype=dtype, mode='r',
+                                shape=(self.__rows,) + shape) \
+                    if self.__rows else None
+                with open(self.__path(name, meta), mode='wb') as file:
+                    for k in range(0, len(rows_idx), self.__COPY_CHUNK):
+                        chunk = rows_idx[k:k + self.__COPY_CHUNK]
+                        file.write(np.ascontiguousarray(old[chunk]).tobytes())
+                del old
+            records['start'] = new_starts
+            meta['rows'] = meta['live_rows']
+        else:
+            meta['rows'] = self.__rows
+        records.tofile(str(self.__path('snapshot', meta)))
+        tmp_path = self.__folder_dir / (META_FILE + '.tmp')
+        with open(tmp_path, mode='w') as file:
+            json.dump(meta, file)
+        self.__snapshot = None
+        self.__arrays = None
+        os.replace(tmp_path, self.__folder_dir / META_FILE)
+        self.__open_generation(meta)
+        self.__remove_old_generations()
+        print('Fingerprint store is compacted: {} rows'.format(meta['rows']))
+
+    def __remove_old_generations(self):
+        """Remove files of generations before current one.
+
+        Files still mapped by other sessions can't be removed on Windows, so
+        they are left until the next compaction or reopening of store.
+        """
+        meta = self.__meta
+        for name in os.listdir(self.__folder_dir):
+            parts = name.split('.')
+            if len(parts) != 3 or not parts[1].isdigit():
+                continue
+            if parts[0] in ('snapshot', 'journal'):
+                current = meta['generation']
+            elif parts[0] in map(lambda f: f[0], self.__row_formats()):
+                current = meta['rows_generation']
+            else:
+                continue
+            if int(parts[1]) < current:
+                try:
+                    os.remove(self.__folder_dir / name)
+                except OSError:
+                    pass
+
+    def __compute_descriptor(self, fragm):
+        ds = self.__DESCR_SZ
+        thumb = Image.fromarray(fragm).resize((ds, ds), Image.BOX)
+        descr = np.asarray(thumb, dtype=np.float32).ravel()
+        descr = descr - descr.mean()
+        norm = np.linalg.norm(descr)
+        return descr / norm if norm > 0 else descr
+
+    def __compute_rows(self, marks, img):
+        """Return arrays of fragments, descriptors and inside flags."""
+        FW = self.__FRAGM_W
+        grey = img.convert('L')
+        w, h = grey.size
+        fragms = np.empty((len(marks), FW, FW), dtype=np.uint8)
+        descrs = np.empty((len(marks), self.__DESCR_SZ ** 2), np.float32)
+        inside = np.empty((len(marks),), dtype=np.uint8)
+        for k, m in enumerate(marks):
+            fragms[k] = crop_grey_fragment(grey, m, FW)
+            descrs[k] = self.__compute_descriptor(fragms[k])
+            inside[k] = m.cx - FW / 2 >= 0 and m.cy - FW / 2 >= 0 and \
+                m.cx + FW / 2 < w and m.cy + FW / 2 < h
+        return fragms, descrs, inside
+
+    def compute(self, marks, img):
+        """Return list of (fragment, descriptor, inside) without storing.
+
+        It's for the case, when store can't be updated (see update).
+        """
+        fragms, descrs, inside = self.__compute_rows(marks, img)
+        return [(fragms[k], descrs[k], bool(inside[k]))
+                for k in range(len(marks))]
+
+    def update(self, stem, label_hash, marks, img):
+        """Replace fragments of stem by fragments of marks on img.
+
+        Return False, if store is locked by another session for too long.
+        """
+        rows_data = [arr.tobytes()
+                     for arr in self.__compute_rows(marks, img)]
+        with self.__lock:
+            return self.__append(stem, label_hash, rows_data, len(marks))
+
+    def remove(self, stem):
+        """."""
+        with self.__lock:
+            self.__refresh()
+            if not self.__find(stem):
+                return True
+            return self.__append(stem, None, [b'', b'', b''], 0)
+
+    def label_hash(self, stem):
+        """Return hash of label, fragments of which are stored for stem."""
+        with self.__lock:
+            self.__refresh()
+            record = self.__find(stem)
+            return record[0] if record else None
+
+    def __get_arrays(self):
+        if self.__arrays is None or self.__mapped_rows != self.__rows:
+            n = self.__rows
+            arrays = []
+            for name, dtype, shape in self.__row_formats():
+                if n == 0:
+                    arrays.append(np.empty((0,) + shape, dtype=dtype))
+                else:
+                    arrays.append(np.memmap(self.__path(name), dtype=dtype,
+                                            mode='r', shape=(n,) + shape))
+            self.__arrays = tuple(arrays)
+            self.__mapped_rows = n
+        return self.__arrays
+
+    def get(self, stem, label_hash=None):
+        """Return list of (fragment, descriptor, inside) for marks of stem.
+
+        Rows are in order of marks in label. If label_hash is given, rows are
+        returned only for label with this hash.
+        """
+        with self.__lock:
+            while True:
+                self.__refresh()
+                record = self.__find(stem)
+                if not record or label_hash not in (None, record[0]):
+                    return []
+                try:
+                    fragms, descrs, inside = self.__get_arrays()
+                    break
+                except FileNotFoundError:
+                    if self.__read_meta() == self.__meta:
+                        raise
+                    # removed by compaction after refresh
+        _, start, count = record
+        return [(fragms[row], descrs[row], bool(inside[row]))
+                for row in range(start, start + count)]
@@ -0,0 +1,99 @@
+"""Module for FragmentExtractor class."""
+
+import numpy as np
+import cv2 as cv
+from mark import Mark
+
+
+class FragmentExtractor():
+    """Class for extraction of rotation-normalized fragments of marks.
+
+    Every fragment is aligned with its mark: mark direction is along x-axis
+    of fragment, mark center is in the center of fragment, and mark is scaled
+    so that its length and width take 1 / context of fragment width and
+    height. All fragments of one image are sampled by a single cv.remap call
+    with stacked coordinate maps. Parts of fragments outside of image are
+    filled according to border mode instead of dropping such marks.
+    """
+
+    __BORDER_MODES = {'constant': cv.BORDER_CONSTANT,
+                      'replicate': cv.BORDER_REPLICATE,
+                      'reflect': cv.BORDER_REFLECT_101}
+    __MAX_MAP_ROWS = 32767  # cv.remap limit for size of maps
+
+    __size = (50, 50)
+    __context = 2
+    __border_mode = cv.BORDER_REPLICATE
+    __border_value = 0
+
+    def __init__(self, size=(50, 50), context=2, border='replicate',
+                 border_value=0):
+        """Set size of fragments, scale of marks and border padding.
+
+        size - (width, height) of fragments;
+        context - ratio of fragment size to mark size;
+        border - 'constant', 'replicate' or 'reflect';
+        border_value - fill value for 'constant' border.
+        """
+        if border not in self.__BORDER_MODES:
+            raise ValueError('Unknown border mode: {}'.format(border))
+        self.__size = size
+        self.__context = context
+        self.__border_mode = self.__BORDER_MODES[border]
+        self.__border_value = border_value
+
+    def __compute_xfs(self, marks):
+        """Return (N, 2, 3) affine transforms from fragment to image."""
+        W, H = self.__size
+        m_arr = np.array([[m.cx, m.cy, m.w, m.length, m.r] for m in marks],
+                         dtype=np.float64)
+        cx, cy, w, length, r = m_arr.T
+        a = np.radians(r)
+        sx = length * self.__context / W
+        sy = w * self.__context / H
+        cos, sin = np.cos(a), np.sin(a)
+        xfs = np.empty((len(marks), 2, 3))
+        xfs[:, 0, 0], xfs[:, 0, 1] = cos * sx, -sin * sy
+        xfs[:, 1, 0], xfs[:, 1, 1] = sin * sx, cos * sy
+        # fragment center goes to mark center; marks use pixel-edge
+        # coordinates, cv uses pixel-center ones, hence 0.5
+        xfs[:, 0, 2] = cx - 0.5 - xfs[:, 0, 0] * W / 2 - xfs[:, 0, 1] * H / 2
+        xfs[:, 1, 2] = cy - 0.5 - xfs[:, 1, 0] * W / 2 - xfs[:, 1, 1] * H / 2
+        return xfs
+
+    def __compute_maps(self, xfs):
+        W, H = self.__size
+        u, v = np.meshgrid(np.arange(W) + 0.5, np.arange(H) + 0.5)
+        map_x = (xfs[:, 0, 0, None, None] * u + xfs[:, 0, 1, None, None] * v
+                 + xfs[:, 0, 2, None, None])
+        map_y = (xfs[:, 1, 0, None, None] * u + xfs[:, 1, 1, None, None] * v
+                 + xfs[:, 1, 2, None, None])
+        return (map_x.reshape(-1, W).astype(np.float32),
+                map_y.reshape(-1, W).astype(np.float32))
+
+    def fragment_mark(self):
+        """Return mark of any fragment in fragment coordinates."""
+        W, H = self.__size
+        return Mark(W / 2, H / 2, H / self.__context, W / self.__context, 0)
+
+    def extract(self, img, marks):
+        """Return fragments of all marks on img as (N, H, W, C) uint8 array.
+
+        img - PIL-image or array.
+        """
+        W, H = self.__size
+        img_arr = np.asarray(img.convert('RGB') if hasattr(img, 'convert')
+                             else img, dtype=np.uint8)
+        shape = img_arr.shape[2:]
+        if not marks:
+            return np.empty((0, H, W) + shape, dtype=np.uint8)
+        xfs = self.__compute_xfs(marks)
+        chunk = max(self.__MAX_MAP_ROWS // H, 1)
+        res = []
+        for k in range(0, len(marks), chunk):
+            map_x, map_y = self.__compute_maps(xfs[k:k + chunk])
+            fragms = cv.remap(img_arr, map_x, map_y, cv.INTER_LINEAR,
+                              borderMode=self.__border_mode,
+                              borderValue=self.__border_value)
+            res.append(fragms.reshape((-1, H, W) + shape))
+        return np.concatenate(res)
@@ -0,0 +1,187 @@
+"""Module for LeaseManager class."""
+
+import os
+import json
+import time
+import uuid
+import socket
+
+
+class LeaseManager():
+    """Class for partitioning of dataset images between annotators.
+
+    Every session claims images (stems) by lease-files in shared folder:
+    <leases_dir>/<stem>.lock with json {'session': ..., 'expires': ...}.
+    Lease-file is created exclusively (O_EXCL), so only one session can own
+    a stem. Lease expires, if it is not prolonged by heartbeat (e.g. session
+    was killed), and then can be taken over by another session.
+    Expiration uses wall clock, so clocks of annotators' machines are
+    supposed to be roughly synchronized.
+    """
+
+    __EXPIRY_SEC = 300
+    __SAFE_REPLACE_PART = 0.1  # of expiry, left until heartbeat's deadline
+
+    __leases_dir = None
+    __session_id = None
+    __expiry = __EXPIRY_SEC
+    __owned = None
+
+    def __init__(self, leases_dir, session_id=None, expiry=None):
+        """."""
+        self.__leases_dir = leases_dir
+        if session_id is None:
+            session_id = '{}-{}'.format(socket.gethostname(),
+                                        uuid.uuid4().hex[:8])
+        self.__session_id = session_id
+        if expiry is not None:
+            self.__expiry = expiry
+        self.__owned = set()
+        os.makedirs(self.__leases_dir, exist_ok=True)
+
+    def session_id(self):
+        """."""
+        return self.__session_id
+
+    def __lock_path(self, stem):
+        return self.__leases_dir / (stem + '.lock')
+
+    def __lease_content(self):
+        return json.dumps({'session': self.__session_id,
+                           'expires': time.time() + self.__expiry})
+
+    def __read_lease_file(self, path):
+        """Return lease info or None, if lease-file absents.
+
+        Empty or unreadable lease-file can be just created by another session
+        and not written yet (or left by session killed right after creation),
+        so it's considered as lease of unknown session, which expires after
+        expiry time from modification of file.
+        """
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            pass
+        try:
+            return {'session': None,
+                    'expires': os.path.getmtime(path) + self.__expiry}
+        except FileNotFoundError:
+            return None
+
+    def __read_lease(self, stem):
+        return self.__read_lease_file(self.__lock_path(stem))
+
+    def __create_lease(self, stem):
+        try:
+            fd = os.open(self.__lock_path(stem),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, mode='w') as file:
+            file.write(self.__lease_content())
+        return True
+
+    def __try_acquire(self, stem):
+        if self.__create_lease(stem):
+            return True
+        info = self.__read_lease(stem)
+        if info is None:
+            return self.__create_lease(stem)
+        if info['expires'] > time.time():
+            return info['session'] == self.__session_id
+        # take over expired lease: rename is atomic, so only one session
+        # can move stale file away
+        path = self.__lock_path(stem)
+        stale_path = path.with_name(path.name + '.' + self.__session_id)
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            return False
+        info = self.__read_lease_file(stale_path)
+        if info is not None and info['expires'] > time.time():
+            # another session has taken over the lease in the meantime:
+            # put it back, but only if a third session hasn't created a new
+            # lease yet (link, unlike replace, fails on existing path)
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return self.__create_lease(stem)
+
+    def claim(self, stems, num):
+        """Claim up to num stems from iterable stems, return claimed ones."""
+        claimed = []
+        for stem in stems:
+            if len(claimed) >= num:
+                break
+            if stem in self.__owned:
+                continue
+            if self.__try_acquire(stem):
+                self.__owned.add(stem)
+                claimed.append(stem)
+        return claimed
+
+    def owned_stems(self):
+        """."""
+        return sorted(self.__owned)
+
+    def holder(self, stem):
+        """Return session id of alive lease for stem or None."""
+        info = self.__read_lease(stem)
+        if info is None or info['expires'] <= time.time():
+            return None
+        return info['session']
+
+    def is_leased_by_other(self, stem):
+        """Check if stem has alive lease of another (maybe unknown) session."""
+        info = self.__read_lease(stem)
+        return (info is not None and info['expires'] > time.time()
+                and info['session'] != self.__session_id)
+
+    def heartbeat(self):
+        """Prolong all owned leases, forget leases taken by other sessions.
+
+        Lease is rewritten in place only if it's far from expiration, so it
+        can't be taken over by another session meanwhile. Expired lease is
+        acquired again as any other one.
+        """
+        for stem in list(self.__owned):
+            info = self.__read_lease(stem)
+            if info is None or info['session'] != self.__session_id:
+                self.__owned.discard(stem)
+                continue
+            time_left = info['expires'] - time.time()
+            if time_left <= 0:
+                if not self.__try_acquire(stem):
+                    self.__owned.discard(stem)
+                continue
+            if time_left < self.__expiry * self.__SAFE_REPLACE_PART:
+                continue  # will be acquired again, when it expires
+            path = self.__lock_path(stem)
+            tmp_path = path.with_name(path.name + '.' + self.__session_id)
+            with open(tmp_path, mode='w') as file:
+                file.write(self.__lease_content())
+            os.replace(tmp_path, path)
+
+    def release(self, stem):
+        """."""
+        if stem not in self.__owned:
+            return
+        self.__owned.discard(stem)
+        info = self.__read_lease(stem)
+        if info is not None and info['session'] == self.__session_id:
+            try:
+                os.remove(self.__lock_path(stem))
+            except FileNotFoundError:
+                pass
+
+    def release_all(self):
+        """."""
+        for stem in list(self.__owned):
+            self.release(stem)
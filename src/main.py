@@ -1,36 +1,69 @@
 """Main module for cars-marker.
 
-This module consists all logic of top level
+This module consists all logic of top level.
+
+Startup is staged to show the window and the current frame as soon as
+possible: modules with heavy imports (PIL, numpy) are imported after the
+window is shown, cv2 - only on first template matching, catalog of dataset
+and history of previous images (for already marked fragments) are loaded
+in background threads.
 """
 
+import time
+import argparse
 import tkinter as tk
+import tkinter.messagebox
 import pathlib
 
-from datasetmanager import DatasetManager
-from markmanager import MarkManager
+from backgroundtask import BackgroundTask
+from sessionrecorder import SessionRecorder
 
+START_TIME = time.perf_counter()
 TEST_DS_PATH = pathlib.Path('src/cars_ds_test')
 DS_PATH = pathlib.Path('D:/my_cars_ds')
 BTN_INDENT = 750
 BTN_Y_INDENT = 20
 BTN_Y_STEP = 40
+HEARTBEAT_MS = 60 * 1000
 
 
-def main():
-    """Start application."""
-    root = tk.Tk()
-    root.wm_title('cars_marker')
-    root.wm_iconbitmap('src/images/window.ico')
-    root.geometry('1200x800')
-    root.resizable(width=False, height=False)
+def ask_overwrite():
+    """Ask user, if label should be overwritten in spite of save conflict."""
+    msg = ('Label of this image was changed or the image is leased '
+           'by another annotator. Overwrite label?')
+    return tkinter.messagebox.askyesno('Save conflict', msg)
+
+
+def build_app(root, ds_path, resolve_conflict=ask_overwrite):
+    """Create all controls of application in root, return DatasetManager.
+
+    resolve_conflict - function without arguments, which is called when
+    label can't be saved without conflict with another session and returns
+    True, if label should be overwritten.
+    """
+    # pylint: disable=import-outside-toplevel
+    from datasetmanager import DatasetManager
+    from markmanager import MarkManager
 
-    ds_m = DatasetManager(DS_PATH)
+    ds_m = DatasetManager(ds_path)
     mark_m = MarkManager(root)
-    mark_m.reset_image(ds_m.get_last())
+    history_task = BackgroundTask(root, mark_m.set_already_marked)
+
+    def reset_image():
+        current = ds_m.get_current()
+        mark_m.reset_image(current)
+        history = ds_m.iter_last_fingerprints()
+        history_task.start(lambda is_stale: mark_m.find_already_marked(
+            current[1], history, is_stale))
+
+    reset_image()
+    root.update()
+    print('Time to first frame: {:.3f} s'.format(
+        time.perf_counter() - START_TIME))
 
     def move_to_prev_img():
         if ds_m.move_backward():
-            mark_m.reset_image(ds_m.get_last())
+            reset_image()
     prev_img_btn = tk.Button(root, text="prev image (Backspace)", width=20)
     prev_img_btn.place(x=BTN_INDENT, y=BTN_Y_INDENT)
     prev_img_btn.config(command=move_to_prev_img)
@@ -38,7 +71,7 @@ def main():
 
     def move_to_next_img():
         if ds_m.move_forward():
-            mark_m.reset_image(ds_m.get_last())
+            reset_image()
     next_img_btn = tk.Button(root, text="next image (Enter)", width=20)
     next_img_btn.place(x=(BTN_INDENT + 180), y=BTN_Y_INDENT)
     next_img_btn.config(command=move_to_next_img)
@@ -46,7 +79,7 @@ def main():
 
     def move_to_first_unmarked_img():
         if ds_m.move_to_first_unmarked():
-            mark_m.reset_image(ds_m.get_last())
+            reset_image()
     first_umm_btn = tk.Button(root, width=28)
     first_umm_btn['text'] = 'move to first unmarked image'
     first_umm_btn.place(x=BTN_INDENT, y=BTN_Y_INDENT + BTN_Y_STEP)
@@ -54,8 +87,11 @@ def main():
 
     def save_label():
         marks = mark_m.serialize_marks()
-        ds_m.save_marks_in_label(marks)
-        mark_m.reset_image(ds_m.get_last())
+        if not ds_m.save_marks_in_label(marks):
+            if not resolve_conflict():
+                return
+            ds_m.save_marks_in_label(marks, force=True)
+        reset_image()
     save_btn = tk.Button(root, text="save marks in label (S)", width=18)
     save_btn.place(x=BTN_INDENT, y=BTN_Y_INDENT + 2 * BTN_Y_STEP)
     save_btn.config(command=save_label)
@@ -63,7 +99,7 @@ def main():
 
     def remove_label():
         if ds_m.remove_label():
-            mark_m.reset_image(ds_m.get_last())
+            reset_image()
     rem_label_btn = tk.Button(root, text="remove label", width=18)
     rem_label_btn.place(x=BTN_INDENT, y=BTN_Y_INDENT + 3 * BTN_Y_STEP)
     rem_label_btn.config(command=remove_label)
@@ -74,10 +110,51 @@ def main():
     create_ds_btn.place(x=BTN_INDENT, y=BTN_Y_INDENT + 4 * BTN_Y_STEP)
     create_ds_btn.config(command=create_ds)
 
+    def create_packed_ds():
+        ds_m.create_fragment_ds(packed=True)
+    create_pds_btn = tk.Button(root, width=28)
+    create_pds_btn['text'] = 'Create packed fragment dataset'
+    create_pds_btn.place(x=BTN_INDENT, y=BTN_Y_INDENT + 5 * BTN_Y_STEP)
+    create_pds_btn.config(command=create_packed_ds)
+
     legend_label = tk.Label(root, text=mark_m.get_legend())
     legend_label.config(justify=tk.LEFT)
     legend_label.place(x=BTN_INDENT, y=500)
 
+    def heartbeat():
+        ds_m.heartbeat()
+        root.after(HEARTBEAT_MS, heartbeat)
+    root.after(HEARTBEAT_MS, heartbeat)
+    return ds_m
+
+
+def main():
+    """Start application."""
+    parser = argparse.ArgumentParser(description='cars_marker')
+    parser.add_argument('--ds', type=pathlib.Path, default=DS_PATH,
+                        help='dataset folder')
+    parser.add_argument('--record', type=pathlib.Path, default=None,
+                        help='save key events of session in this json-file '
+                             '(for replay.py)')
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    root.wm_title('cars_marker')
+    root.wm_iconbitmap('src/images/window.ico')
+    root.geometry('1200x800')
+    root.resizable(width=False, height=False)
+    root.update()
+
+    recorder = SessionRecorder(root) if args.record else None
+    ds_m = build_app(root, args.ds)
+
+    def close():
+        ds_m.close()
+        if recorder:
+            recorder.save(args.record)
+        root.destroy()
+    root.protocol('WM_DELETE_WINDOW', close)
+
     root.mainloop()
 
 
@@ -26,6 +26,7 @@ from PIL import ImageDraw
 import utils
 from mover import Mover
 from rotator import Rotator
+from viewport import Viewport
 from mark import Mark, deserialize_mark
 
 
@@ -38,9 +39,9 @@ class MarkManager():
     - serializes marks (in label-object)
     """
 
-    __IMG_SZ = (224, 224)
-    __SCALE_COEFF = 3
-    __RESIZED_SIZE = (__IMG_SZ[0] * __SCALE_COEFF, __IMG_SZ[1] * __SCALE_COEFF)
+    __VIEW_SIZE = (672, 672)
+    __OVERLAY_SS = 4 / 3  # supersampling of overlay for smooth lines
+    __VISIBLE_MARGIN = 40
 
     __MOVE_C = 1
     __ROT_C = 1
@@ -57,12 +58,16 @@ A, Delete - add/remove new mark;
 Page Down, Page Up - chose next of previous mark on image;
 Left, Right, Up, Down - move chosen mark;
 Control + Left/Right/Up/Down - change width and length of mark;
-W, Q - rotate chosen mark clockwese/counterclockwise.
+W, Q - rotate chosen mark clockwese/counterclockwise;
++, -, mouse wheel - zoom in/out, 0 - show whole image;
+Shift + Left/Right/Up/Down, mouse drag - pan image.
 """
 
     __root = None
     __canvas = None
     __fname_label = None
+    __viewport = None
+    __drag_pos = None
 
     __img = None
     __name = None
@@ -80,8 +85,9 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
         self.__root = root
         self.__canvas = tk.Canvas(root)
         self.__canvas['bg'] = 'white'
-        w, h = self.__RESIZED_SIZE
+        w, h = self.__VIEW_SIZE
         self.__canvas.place(x=20, y=30, width=w, height=h)
+        self.__viewport = Viewport(self.__VIEW_SIZE)
         self.__fname_label = tk.Label(root, text="No image")
         self.__fname_label.place(x=20, y=10)
         self.__redraw()
@@ -101,26 +107,74 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
         r.bind("<Control-Up>", lambda ev: self.__change_length(self.__L_C))
         r.bind("<Control-Down>", lambda ev: self.__change_length(-self.__L_C))
 
-    def reset_image(self, last_images):
+        PAN_STEP = 50
+        vp = self.__viewport
+        r.bind("<Key-plus>", lambda ev: self.__update_view(vp.zoom_in()))
+        r.bind("<Key-equal>", lambda ev: self.__update_view(vp.zoom_in()))
+        r.bind("<Key-minus>", lambda ev: self.__update_view(vp.zoom_out()))
+        r.bind("<Key-0>", lambda ev: self.__update_view(vp.zoom_to_fit()))
+        r.bind("<Shift-Left>", lambda ev: self.__pan(-PAN_STEP, 0))
+        r.bind("<Shift-Right>", lambda ev: self.__pan(PAN_STEP, 0))
+        r.bind("<Shift-Up>", lambda ev: self.__pan(0, -PAN_STEP))
+        r.bind("<Shift-Down>", lambda ev: self.__pan(0, PAN_STEP))
+
+        c = self.__canvas
+        c.bind("<MouseWheel>", lambda ev: self.__zoom_by_wheel(ev, ev.delta))
+        c.bind("<Button-4>", lambda ev: self.__zoom_by_wheel(ev, 1))
+        c.bind("<Button-5>", lambda ev: self.__zoom_by_wheel(ev, -1))
+        c.bind("<ButtonPress-1>", self.__start_drag)
+        c.bind("<B1-Motion>", self.__drag)
+
+    def __update_view(self, changed=True):
+        if changed:
+            self.__redraw()
+
+    def __pan(self, dx, dy):
+        self.__update_view(self.__viewport.pan(dx, dy))
+
+    def __zoom_by_wheel(self, event, delta):
+        anchor = (event.x, event.y)
+        if delta > 0:
+            self.__update_view(self.__viewport.zoom_in(anchor))
+        elif delta < 0:
+            self.__update_view(self.__viewport.zoom_out(anchor))
+
+    def __start_drag(self, event):
+        self.__drag_pos = (event.x, event.y)
+
+    def __drag(self, event):
+        if self.__drag_pos is None:
+            return
+        dx = self.__drag_pos[0] - event.x
+        dy = self.__drag_pos[1] - event.y
+        self.__drag_pos = (event.x, event.y)
+        self.__pan(dx, dy)
+
+    def __show_chosen_mark(self):
+        if self.__chosen_mark_idx is not None:
+            m = self.__marks[self.__chosen_mark_idx]
+            self.__viewport.ensure_visible((m.cx, m.cy),
+                                           self.__VISIBLE_MARGIN)
+
+    def reset_image(self, current):
         """Reset represented image for marked.
 
-        The last image - used for marked, other images - for extracting
-        fragments, that already marked.
+        current - (name, image, label). Fragments, that already marked on
+        other images, are found later (see find_already_marked).
         """
-        current = last_images[-1]
-        other_images = last_images[:-1]
-
         name, img, label = current
+        same_image = name == self.__name
         self.__img = img
         self.__name = name
         self.__init_label = label
-        self.__already_marked = self.__find_already_marked(other_images)
+        self.__already_marked = []
         self.__initial_marks = []
         if label:
             self.__initial_marks = list(map(deserialize_mark, label['marks']))
         self.__marks = copy.deepcopy(self.__initial_marks)
         self.__chosen_mark_idx = 0 if len(self.__marks) > 0 else None
         self.__img = self.__img.convert('RGBA')
+        self.__viewport.reset(self.__img, keep_view=same_image)
         self.__redraw()
 
     def __redraw(self):
@@ -128,7 +182,7 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
             self.__canvas.image = None
             self.__fname_label['text'] = 'no image'
             return
-        img = self.__img.resize(self.__RESIZED_SIZE)
+        img = self.__viewport.render()
         if self.__initial_marks:
             img = self.__draw_marks(img, self.__initial_marks, 'grey',
                                     width=10)
@@ -142,6 +196,7 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
         self.__draw_border(img)
         self.__mark_already_marked_fragms(img)
         img_tk = ImageTk.PhotoImage(img)
+        self.__canvas.delete('all')
         self.__canvas.create_image(0, 0, anchor='nw', image=img_tk)
         self.__canvas.image = img_tk
         lbl_str = 'exists' if self.__init_label else 'absents'
@@ -150,26 +205,41 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
         self.__root.update_idletasks()
 
     def __draw_border(self, img):
-        bi = self.__BORDER_INDENT * self.__SCALE_COEFF
-        w, h = img.size
-        rect = [bi, bi, w-bi, h-bi]
+        bi = self.__BORDER_INDENT
+        w, h = self.__img.size
+        vp = self.__viewport
+        rect = [*vp.source_to_view((bi, bi)),
+                *vp.source_to_view((w - bi, h - bi))]
         draw = ImageDraw.Draw(img)
         draw.rectangle(rect, outline='green')
 
+    def __is_mark_visible(self, mark, visible_rect):
+        DIR_LEN = 20
+        R = max(mark.length, mark.w, DIR_LEN)
+        vr = visible_rect
+        return (vr[0] - R <= mark.cx <= vr[2] + R
+                and vr[1] - R <= mark.cy <= vr[3] + R)
+
     def __draw_marks(self, img, marks, color, width=4):
-        UPSC_C = 4
-        UPSC_SZ = (224 * UPSC_C, 224 * UPSC_C)
-        mark_img = Image.new('RGBA', UPSC_SZ, color=(0, 0, 0, 0))
+        vr = self.__viewport.visible_source_rect()
+        marks = [m for m in marks if self.__is_mark_visible(m, vr)]
+        if not marks:
+            return img
+        SS = self.__OVERLAY_SS
+        vw, vh = self.__VIEW_SIZE
+        ss_size = (int(round(vw * SS)), int(round(vh * SS)))
+        mark_img = Image.new('RGBA', ss_size, color=(0, 0, 0, 0))
+        view_xf = self.__viewport.source_to_view_xf(SS)
         for mark in marks:
-            self.__draw_mark(mark_img, UPSC_C, mark, color=color, width=width)
-        mark_img = mark_img.resize(self.__RESIZED_SIZE)
+            self.__draw_mark(mark_img, view_xf, mark, color=color, width=width)
+        mark_img = mark_img.resize(self.__VIEW_SIZE)
         img.alpha_composite(mark_img)
         return img
 
-    def __draw_mark(self, img, scale, mark, color, width):
+    def __draw_mark(self, img, view_xf, mark, color, width):
         DIR_LEN = 20
         m = mark
-        xf = self.__create_xf(m.r, (m.cx, m.cy), scale)
+        xf = self.__create_xf(m.r, (m.cx, m.cy), view_xf)
         draw = ImageDraw.Draw(img)
         pline = [(m.length / 2, m.w / 2), (m.length / 2, -m.w / 2),
                  (-m.length / 2, -m.w / 2), (-m.length / 2, m.w / 2)]
@@ -179,11 +249,10 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
         draw.line(arrow_pts, fill=color, width=width)
         return img
 
-    def __create_xf(self, rot, translation, scale):
+    def __create_xf(self, rot, translation, view_xf):
         rot_xf = utils.create_rotation_around_center_xf(rot)
         trans_xf = utils.create_translation_xf(translation)
-        scale_xf = utils.create_scale_xf(scale)
-        xf = utils.combine_xfs([trans_xf, rot_xf, scale_xf])
+        xf = utils.combine_xfs([view_xf, trans_xf, rot_xf])
         return xf
 
     def get_legend(self):
@@ -193,20 +262,29 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
     def __choose_prev_mark(self):
         if self.__chosen_mark_idx > 0:
             self.__chosen_mark_idx -= 1
+            self.__show_chosen_mark()
             self.__redraw()
 
     def __choose_next_mark(self):
         if self.__chosen_mark_idx < len(self.__marks) - 1:
             self.__chosen_mark_idx += 1
+            self.__show_chosen_mark()
             self.__redraw()
 
     def __add_mark_and_select_it(self):
-        m = Mark(self.__IMG_SZ[0] / 2, self.__IMG_SZ[1] / 2, 10, 20, 0)
+        if not self.__img:
+            return
+        # new mark is placed in the center of visible part of image
+        vr = self.__viewport.visible_source_rect()
+        w, h = self.__img.size
+        cx = int(np.clip((vr[0] + vr[2]) / 2, 0, w))
+        cy = int(np.clip((vr[1] + vr[3]) / 2, 0, h))
+        m = Mark(cx, cy, 10, 20, 0)
         if self.__marks:
             SH_C = 5
             lm = self.__marks[-1]
-            m.cx += SH_C if lm.cx < self.__IMG_SZ[0] / 2 else -SH_C
-            m.cy += SH_C if lm.cy < self.__IMG_SZ[1] / 2 else -SH_C
+            m.cx += SH_C if lm.cx < cx else -SH_C
+            m.cy += SH_C if lm.cy < cy else -SH_C
         self.__marks.append(m)
         self.__chosen_mark_idx = len(self.__marks) - 1
         self.__redraw()
@@ -216,6 +294,7 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
             del self.__marks[-1]
             m_len = len(self.__marks)
             self.__chosen_mark_idx = (m_len - 1) if m_len > 0 else None
+            self.__show_chosen_mark()
             self.__redraw()
 
     def __move_mark(self, shift):
@@ -223,8 +302,10 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
             chosen_mark = self.__marks[self.__chosen_mark_idx]
             chosen_mark.cx += shift[0]
             chosen_mark.cy -= shift[1]  # because of y inversion
-            chosen_mark.cx = int(np.clip(chosen_mark.cx, 0, self.__IMG_SZ[0]))
-            chosen_mark.cy = int(np.clip(chosen_mark.cy, 0, self.__IMG_SZ[1]))
+            w, h = self.__img.size
+            chosen_mark.cx = int(np.clip(chosen_mark.cx, 0, w))
+            chosen_mark.cy = int(np.clip(chosen_mark.cy, 0, h))
+            self.__show_chosen_mark()
             self.__redraw()
 
     def __rotate_mark(self, rot):
@@ -258,33 +339,50 @@ W, Q - rotate chosen mark clockwese/counterclockwise.
         label['marks'] = list(map(lambda m: m.serialized(), self.__marks))
         return label
 
-    def __find_already_marked(self, other_images):
-        """Find on current image fragments, that already marked on previous."""
+    def find_already_marked(self, cur_img, fingerprints, is_stale=None):
+        """Find on cur_img fragments, that already marked on other images.
+
+        fingerprints - iterable of lists of (mark, grey fragment, ...) for
+        every other image (see DatasetManager.iter_last_fingerprints), only
+        central part of fragments is matched.
+        Can be run in worker thread (it doesn't change MarkManager), returns
+        None if is_stale() becomes True.
+        """
         # already_marked_fragms = [[50, 50, 80, 80], [100, 100, 130, 130]]
         FW = self.__FRAGM_W
+        cur_grey = np.asarray(cur_img.convert('L'))
         rects = []
-        for _, img, label in other_images:
-            if label is None:
-                continue
-            marks = list(map(deserialize_mark, label['marks']))
-            for m in marks:
-                crop_rect = [m.cx - FW / 2, m.cy - FW / 2,
-                             m.cx + FW/2, m.cy + FW / 2]
-                fragm = img.crop(crop_rect)
-                new_rects = utils.find_matches(self.__img, fragm, 0.96)
+        for img_fingerprints in fingerprints:
+            if is_stale is not None and is_stale():
+                return None
+            for fingerprint in img_fingerprints:
+                fragm = fingerprint[1]
+                i = (fragm.shape[0] - FW) // 2
+                center_part = fragm[i:i + FW, i:i + FW]
+                new_rects = utils.find_matches(cur_grey, center_part, 0.96)
                 rects += new_rects
         return rects
 
+    def set_already_marked(self, rects):
+        """Set fragments of current image, that already marked, and show."""
+        self.__already_marked = rects
+        self.__redraw()
+
     def __draw_x(self, img, center, width, color, linewidth):
         c = center
         draw = ImageDraw.Draw(img)
         R = width / 2
-        r = [c[0] - R, c[1] - R, c[0] + R, c[1] + R]
-        r = list(map(lambda x: x * self.__SCALE_COEFF, r))
+        vp = self.__viewport
+        r = [*vp.source_to_view((c[0] - R, c[1] - R)),
+             *vp.source_to_view((c[0] + R, c[1] + R))]
         draw.line(r, fill=color, width=5)
         draw.line([r[2], r[1], r[0], r[3]], fill=color, width=linewidth)
 
     def __mark_already_marked_fragms(self, img):
+        vr = self.__viewport.visible_source_rect()
         for rect in self.__already_marked:
+            if (rect[2] < vr[0] or rect[0] > vr[2]
+                    or rect[3] < vr[1] or rect[1] > vr[3]):
+                continue
             c = ((rect[2] + rect[0]) / 2, (rect[3] + rect[1]) / 2)
             self.__draw_x(img, c, 10, 'yellow', 5)
@@ -0,0 +1,193 @@
+"""Module for packed fragment dataset: PackedFragmentWriter and -Reader.
+
+Packed fragment dataset is a folder with files:
+- fragments.u8 - raw uint8 array of shape (N, FW, FW, 3), fragment after
+  fragment, without any header (so it can be memory-mapped directly);
+- marks.f32 - raw float32 array of shape (N, 5) with mark parameters in
+  columns (center_x, center_y, width, length, rot_deg);
+- sources.i32 - raw int32 array of shape (N,): index of source image of
+  every fragment in names table;
+- names.txt - names table: names of source images, one per line;
+- index.json - fragment shape, number of fragments and size of names table.
+
+All files except index are written in append mode, so dataset can be
+extended chunk by chunk. Small index is rewritten after every chunk, and the
+reader trusts only the sizes from index, so partially written chunk is never
+visible.
+"""
+
+import os
+import json
+import numpy as np
+from mark import Mark
+
+FRAGMENTS_FILE = 'fragments.u8'
+MARKS_FILE = 'marks.f32'
+SOURCES_FILE = 'sources.i32'
+NAMES_FILE = 'names.txt'
+INDEX_FILE = 'index.json'
+MARK_COLUMNS = ['center_x', 'center_y', 'width', 'length', 'rot_deg']
+
+
+def read_names(folder_path, names_size):
+    """Read names table (only names_size bytes, written by index)."""
+    path = folder_path / NAMES_FILE
+    if names_size == 0 or not path.exists():
+        return []
+    with open(path, mode='rb') as file:
+        data = file.read(names_size)
+    return data.decode('utf-8').splitlines()
+
+
+class PackedFragmentWriter():
+    """Class for appending fragments and marks to packed dataset."""
+
+    __folder_dir = None
+    __fragm_shape = None
+    __count = 0
+    __names = {}
+    __names_size = 0
+
+    def __init__(self, folder_path, fragm_width, channels=3):
+        """Open packed dataset for appending (create it, if not exists)."""
+        self.__folder_dir = folder_path
+        self.__fragm_shape = (fragm_width, fragm_width, channels)
+        self.__count = 0
+        self.__names = {}
+        self.__names_size = 0
+        index_path = self.__folder_dir / INDEX_FILE
+        if index_path.exists():
+            with open(index_path) as file:
+                index = json.load(file)
+            if tuple(index['fragm_shape']) != self.__fragm_shape:
+                raise ValueError('Packed dataset has another fragment shape')
+            self.__count = index['count']
+            self.__names_size = index['names_size']
+            names = read_names(self.__folder_dir, self.__names_size)
+            self.__names = {n: k for k, n in enumerate(names)}
+            self.__truncate_to_index()
+        else:
+            os.makedirs(self.__folder_dir, exist_ok=True)
+            self.__truncate_to_index()
+            self.__save_index()
+
+    def __truncate_to_index(self):
+        """Drop tails of files, left by interrupted append."""
+        fr_size = int(np.prod(self.__fragm_shape))
+        sizes = [(FRAGMENTS_FILE, self.__count * fr_size),
+                 (MARKS_FILE, self.__count * len(MARK_COLUMNS) * 4),
+                 (SOURCES_FILE, self.__count * 4),
+                 (NAMES_FILE, self.__names_size)]
+        for name, size in sizes:
+            with open(self.__folder_dir / name, mode='ab') as file:
+                file.truncate(size)
+
+    def __save_index(self):
+        index = {'fragm_shape': list(self.__fragm_shape),
+                 'count': self.__count,
+                 'mark_columns': MARK_COLUMNS,
+                 'names_size': self.__names_size}
+        tmp_path = self.__folder_dir / (INDEX_FILE + '.tmp')
+        with open(tmp_path, mode='w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, self.__folder_dir / INDEX_FILE)
+
+    def __source_indices(self, sources):
+        """Return indices of sources in names table, append new names."""
+        new_names = []
+        indices = np.empty(len(sources), dtype=np.int32)
+        for k, name in enumerate(sources):
+            if name not in self.__names:
+                self.__names[name] = len(self.__names)
+                new_names.append(name)
+            indices[k] = self.__names[name]
+        if new_names:
+            data = ''.join(map(lambda n: n + '\n', new_names)).encode('utf-8')
+            with open(self.__folder_dir / NAMES_FILE, mode='ab') as file:
+                file.write(data)
+            self.__names_size += len(data)
+        return indices
+
+    def append(self, fragments, marks, sources):
+        """Append chunk of fragments (PIL-images or arrays) with their marks.
+
+        sources - names of images, fragments were extracted from.
+        """
+        if not (len(fragments) == len(marks) == len(sources)):
+            raise ValueError('Fragments, marks and sources differ in length')
+        if not len(fragments):
+            return
+        mode = 'RGB' if self.__fragm_shape[2] == 3 else 'L'
+        fr_arr = np.empty((len(fragments),) + self.__fragm_shape, np.uint8)
+        for k, fragm in enumerate(fragments):
+            if hasattr(fragm, 'convert'):
+                fragm = fragm.convert(mode)
+            fr_arr[k] = np.asarray(fragm, dtype=np.uint8).reshape(
+                self.__fragm_shape)
+        m_arr = np.array([[m.cx, m.cy, m.w, m.length, m.r] for m in marks],
+                         dtype=np.float32)
+        src_arr = self.__source_indices(sources)
+        with open(self.__folder_dir / FRAGMENTS_FILE, mode='ab') as file:
+            file.write(fr_arr.tobytes())
+        with open(self.__folder_dir / MARKS_FILE, mode='ab') as file:
+            file.write(m_arr.tobytes())
+        with open(self.__folder_dir / SOURCES_FILE, mode='ab') as file:
+            file.write(src_arr.tobytes())
+        self.__count += len(fragments)
+        self.__save_index()
+
+    def count(self):
+        """."""
+        return self.__count
+
+
+class PackedFragmentReader():
+    """Class for zero-copy reading of packed dataset.
+
+    fragments, marks and source_indices are read-only np.memmap objects,
+    so any slice of them is a view on file without copying.
+    """
+
+    fragments = None
+    marks = None
+    source_indices = None
+    names = []
+
+    def __init__(self, folder_path):
+        """."""
+        with open(folder_path / INDEX_FILE) as file:
+            index = json.load(file)
+        count = index['count']
+        shape = tuple(index['fragm_shape'])
+        self.names = read_names(folder_path, index['names_size'])
+        if count == 0:
+            self.fragments = np.empty((0,) + shape, dtype=np.uint8)
+            self.marks = np.empty((0, len(MARK_COLUMNS)), dtype=np.float32)
+            self.source_indices = np.empty((0,), dtype=np.int32)
+            return
+        self.fragments = np.memmap(folder_path / FRAGMENTS_FILE,
+                                   dtype=np.uint8, mode='r',
+                                   shape=(count,) + shape)
+        self.marks = np.memmap(folder_path / MARKS_FILE,
+                               dtype=np.float32, mode='r',
+                               shape=(count, len(MARK_COLUMNS)))
+        self.source_indices = np.memmap(folder_path / SOURCES_FILE,
+                                        dtype=np.int32, mode='r',
+                                        shape=(count,))
+
+    def __len__(self):
+        """."""
+        return len(self.fragments)
+
+    def __getitem__(self, key):
+        """Return fragments and marks arrays for index or slice."""
+        return self.fragments[key], self.marks[key]
+
+    def get_mark(self, index):
+        """Return mark of fragment as Mark-object."""
+        cx, cy, w, length, r = map(float, self.marks[index])
+        return Mark(cx, cy, w, length, r)
+
+    def get_source(self, index):
+        """Return name of source image of fragment."""
+        return self.names[self.source_indices[index]]
@@ -0,0 +1,150 @@
+"""Replay of recorded annotation session for latency testing.
+
+Session is recorded by main.py with --record option (see SessionRecorder).
+Replay builds the application in Tk root placed off-screen (key events
+are delivered only to a mapped window with focus) against given dataset and
+feeds recorded key events with recorded timing, measuring how long every
+event is handled. Labels are saved by replayed S-presses as usual, so replay
+should be run against a copy of dataset. Save conflicts (e.g. with leases of
+recorded session, copied with dataset) never prompt: such saves are skipped
+and counted in report.
+
+Usage:
+    python src/replay.py session.json --ds path/to/ds_copy [--speed 2]
+                         [--report report.json]
+"""
+
+import time
+import json
+import argparse
+import pathlib
+import statistics
+import tkinter as tk
+
+from sessionrecorder import load_session
+from main import build_app
+
+QUEUE_TOLERANCE = 0.005  # lag of event handling start, considered as queued
+WAIT_STEP = 0.001
+OFFSCREEN_GEOMETRY = '1200x800+-3000+-3000'
+
+
+def replay_session(root, events, speed=1.0):
+    """Feed events to root and return report about their handling.
+
+    speed - ratio of replay speed to recorded one, 0 - as fast as possible.
+    Event is queued, if its handling started later than it was recorded
+    (because previous events or background callbacks weren't handled yet).
+    Event is dropped, if it doesn't reach bindings of application (checked
+    by counter bound to all key events), e.g. when root has no focus.
+    """
+    per_event = []
+    dropped = 0
+    delivered = [0]
+
+    def count_delivered():
+        delivered[0] += 1
+    root.bind_all('<KeyPress>', lambda ev: count_delivered(), add='+')
+    root.bind_all('<KeyRelease>', lambda ev: count_delivered(), add='+')
+    root.focus_force()
+    root.update()
+    start = time.perf_counter()
+    for ev in events:
+        target = start + (ev['t'] / speed if speed > 0 else 0)
+        while time.perf_counter() < target:
+            root.update()
+            time.sleep(WAIT_STEP)
+        begin = time.perf_counter()
+        kind = 'KeyPress' if ev['type'] == 'press' else 'KeyRelease'
+        seq = '<{}-{}>'.format(kind, ev['keysym'])
+        delivered_before = delivered[0]
+        try:
+            root.event_generate(seq, state=ev['state'])
+        except tk.TclError:
+            dropped += 1
+            continue
+        root.update_idletasks()
+        end = time.perf_counter()
+        if delivered[0] == delivered_before:
+            dropped += 1
+            root.update()
+            continue
+        lag = begin - target if speed > 0 else 0
+        per_event.append({'t': ev['t'], 'type': ev['type'],
+                          'keysym': ev['keysym'], 'latency': end - begin,
+                          'lag': lag})
+        root.update()  # as mainloop does, for after-callbacks
+    wall_time = time.perf_counter() - start
+
+    latencies = sorted(map(lambda e: e['latency'], per_event))
+    lags = list(map(lambda e: e['lag'], per_event))
+    report = {'events': len(events), 'handled': len(per_event),
+              'dropped': dropped,
+              'queued': sum(1 for lag in lags if lag > QUEUE_TOLERANCE),
+              'max_lag': max(lags, default=0), 'wall_time': wall_time,
+              'per_event': per_event}
+    if latencies:
+        p95_idx = min(int(len(latencies) * 0.95), len(latencies) - 1)
+        report['latency'] = {'mean': statistics.mean(latencies),
+                             'median': statistics.median(latencies),
+                             'p95': latencies[p95_idx],
+                             'max': latencies[-1]}
+    return report
+
+
+def print_report(report):
+    """."""
+    print('events: {}, handled: {}, dropped: {}, queued: {}'.format(
+        report['events'], report['handled'], report['dropped'],
+        report['queued']))
+    if 'latency' in report:
+        lat = report['latency']
+        print('latency, ms: mean {:.1f}, median {:.1f}, p95 {:.1f}, '
+              'max {:.1f}'.format(lat['mean'] * 1000, lat['median'] * 1000,
+                                  lat['p95'] * 1000, lat['max'] * 1000))
+    print('max lag: {:.1f} ms, wall time: {:.3f} s'.format(
+        report['max_lag'] * 1000, report['wall_time']))
+    if report.get('save_conflicts'):
+        print('saves skipped because of conflict: {}'.format(
+            report['save_conflicts']))
+
+
+def main():
+    """Replay session and print report."""
+    parser = argparse.ArgumentParser(description='cars_marker replay')
+    parser.add_argument('session', type=pathlib.Path,
+                        help='json-file with recorded session')
+    parser.add_argument('--ds', type=pathlib.Path, required=True,
+                        help='dataset folder (labels can be changed)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, 0 - as fast as possible')
+    parser.add_argument('--report', type=pathlib.Path, default=None,
+                        help='save full report in this json-file')
+    args = parser.parse_args()
+
+    events = load_session(args.session)
+    root = tk.Tk()
+    root.geometry(OFFSCREEN_GEOMETRY)
+    root.update()
+    conflicts = [0]
+
+    def skip_conflict():
+        conflicts[0] += 1
+        return False  # modal dialog would block replay
+    ds_m = build_app(root, args.ds, resolve_conflict=skip_conflict)
+    report = replay_session(root, events, args.speed)
+    report['save_conflicts'] = conflicts[0]
+    ds_m.close()
+    root.destroy()
+
+    print_report(report)
+    if report['events'] and report['handled'] == 0:
+        print('No events were delivered: check that replay window can '
+              'get keyboard focus.')
+    if args.report:
+        with open(args.report, mode='w') as file:
+            json.dump(report, file, indent=' '*4)
+
+
+if __name__ == '__main__':
+    main()
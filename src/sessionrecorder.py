@@ -0,0 +1,64 @@
+"""Module for SessionRecorder class.
+
+Example of session.json:
+{
+    'version': 1,
+    'events': [
+        {'t': 0.0, 'type': 'press', 'keysym': 'Right', 'state': 0},
+        {'t': 0.031, 'type': 'release', 'keysym': 'Right', 'state': 0},
+        {'t': 1.25, 'type': 'press', 'keysym': 'Left', 'state': 4}
+    ]
+}
+t - seconds from the first event, state - modifiers mask (4 - Control).
+"""
+
+import json
+
+SESSION_VERSION = 1
+
+
+class SessionRecorder():
+    """Class for recording key events of annotation session.
+
+    Recorder listens all key presses and releases of application (bind_all),
+    so it doesn't interfere with handlers of MarkManager, Mover, etc.
+    Timestamps are taken from events themselves, so they are times of key
+    presses, not of their handling.
+    """
+
+    __events = []
+    __first_time = None
+
+    def __init__(self, root):
+        """."""
+        self.__events = []
+        root.bind_all('<KeyPress>', lambda ev: self.__record(ev, 'press'),
+                      add='+')
+        root.bind_all('<KeyRelease>',
+                      lambda ev: self.__record(ev, 'release'), add='+')
+
+    def __record(self, event, ev_type):
+        if self.__first_time is None:
+            self.__first_time = event.time
+        t = (event.time - self.__first_time) / 1000
+        self.__events.append({'t': t, 'type': ev_type,
+                              'keysym': event.keysym, 'state': event.state})
+
+    def events(self):
+        """."""
+        return list(self.__events)
+
+    def save(self, path):
+        """Save recorded session in json-file."""
+        session = {'version': SESSION_VERSION, 'events': self.__events}
+        with open(path, mode='w') as file:
+            json.dump(session, file, indent=' '*4)
+
+
+def load_session(path):
+    """Return list of events of recorded session."""
+    with open(path) as file:
+        session = json.load(file)
+    if session.get('version') != SESSION_VERSION:
+        raise ValueError('Unsupported session version')
+    return session['events']
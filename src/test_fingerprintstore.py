@@ -0,0 +1,139 @@
+"""Tests for FingerprintStore."""
+
+import os
+import json
+import numpy as np
+import pytest
+from PIL import Image
+from mark import Mark
+import fingerprintstore
+from fingerprintstore import FingerprintStore
+
+
+@pytest.fixture(name='img')
+def fixture_img():
+    rnd = np.random.RandomState(0)
+    return Image.fromarray(rnd.randint(0, 256, (120, 160, 3), np.uint8))
+
+
+@pytest.fixture(name='small_store')
+def fixture_small_store(monkeypatch):
+    """Make store compact after a few rows and journal records."""
+    monkeypatch.setattr(FingerprintStore,
+                        '_FingerprintStore__COMPACT_MIN_ROWS', 8)
+    monkeypatch.setattr(FingerprintStore, '_FingerprintStore__JOURNAL_MAX', 6)
+
+
+def make_marks(num, shift=0):
+    return [Mark(30 + 10 * k + shift, 40, 10, 20, 0) for k in range(num)]
+
+
+def check_rows(store, stem, label_hash, marks, img):
+    rows = store.get(stem, label_hash)
+    expected = store.compute(marks, img)
+    assert len(rows) == len(expected)
+    for (fragm, descr, inside), (e_fragm, e_descr, e_inside) in \
+            zip(rows, expected):
+        assert np.array_equal(fragm, e_fragm)
+        assert np.allclose(descr, e_descr)
+        assert inside == e_inside
+
+
+def test_update_get_remove(tmp_path, img):
+    store = FingerprintStore(tmp_path)
+    marks = make_marks(2) + [Mark(5, 5, 10, 20, 0)]
+    assert store.update('s1', 'h1', marks, img)
+    assert store.label_hash('s1') == 'h1'
+    check_rows(store, 's1', 'h1', marks, img)
+    assert [row[2] for row in store.get('s1')] == [True, True, False]
+    assert store.get('s1', 'other_hash') == []
+    assert store.remove('s1')
+    assert store.label_hash('s1') is None
+    assert store.get('s1') == []
+
+
+def test_reopen_after_compaction(tmp_path, img, small_store):
+    store = FingerprintStore(tmp_path)
+    for k in range(10):
+        store.update('s{}'.format(k % 3), 'h{}'.format(k), make_marks(2, k),
+                     img)
+    store.remove('s2')
+    meta = json.loads((tmp_path / fingerprintstore.META_FILE).read_text())
+    assert meta['generation'] > 0
+    assert meta['live_rows'] <= 4
+
+    reopened = FingerprintStore(tmp_path)
+    assert reopened.label_hash('s0') == 'h9'
+    assert reopened.label_hash('s1') == 'h7'
+    assert reopened.label_hash('s2') is None
+    check_rows(reopened, 's0', 'h9', make_marks(2, 9), img)
+    check_rows(reopened, 's1', 'h7', make_marks(2, 7), img)
+
+
+def test_instances_interleave(tmp_path, img, small_store):
+    store_a = FingerprintStore(tmp_path)
+    store_b = FingerprintStore(tmp_path)
+    expected = {}
+    for k in range(12):
+        store, other = (store_a, store_b) if k % 2 else (store_b, store_a)
+        stem = 's{}'.format(k % 4)
+        if k % 5 == 4:
+            assert store.remove(stem)
+            expected.pop(stem, None)
+        else:
+            assert store.update(stem, 'h{}'.format(k), make_marks(1, k), img)
+            expected[stem] = k
+        assert other.label_hash(stem) == store.label_hash(stem)
+    for store in (store_a, store_b):
+        for n in range(4):
+            stem = 's{}'.format(n)
+            if stem not in expected:
+                assert store.get(stem) == []
+                continue
+            k = expected[stem]
+            check_rows(store, stem, 'h{}'.format(k), make_marks(1, k), img)
+
+
+def test_old_generations_are_removed(tmp_path, img, small_store):
+    store = FingerprintStore(tmp_path)
+    for k in range(10):
+        store.update('s0', 'h{}'.format(k), make_marks(1), img)
+    meta = json.loads((tmp_path / fingerprintstore.META_FILE).read_text())
+    assert meta['rows_generation'] > 0
+    # files left by compaction, when they were mapped by another session
+    for name in ['snapshot.0.bin', 'journal.0.bin', 'fragments.0.u8']:
+        (tmp_path / name).write_bytes(b'')
+    FingerprintStore(tmp_path)
+    for name in os.listdir(tmp_path):
+        parts = name.split('.')
+        if parts[0] in ('snapshot', 'journal'):
+            assert int(parts[1]) == meta['generation']
+        elif parts[0] in ('fragments', 'descriptors', 'inside'):
+            assert int(parts[1]) == meta['rows_generation']
+
+
+def test_recovery_from_interrupted_append(tmp_path, img):
+    store = FingerprintStore(tmp_path)
+    store.update('s1', 'h1', make_marks(2), img)
+    # tails of append, interrupted before journal record was completed
+    for name in ['fragments.0.u8', 'descriptors.0.f32', 'inside.0.u8']:
+        with open(tmp_path / name, mode='ab') as file:
+            file.write(b'\x07' * 7)
+    with open(tmp_path / 'journal.0.bin', mode='ab') as file:
+        file.write(b'\x07' * (fingerprintstore.RECORD_DTYPE.itemsize // 2))
+
+    reopened = FingerprintStore(tmp_path)
+    assert reopened.label_hash('s1') == 'h1'
+    assert reopened.update('s2', 'h2', make_marks(3, 5), img)
+    store = FingerprintStore(tmp_path)
+    check_rows(store, 's1', 'h1', make_marks(2), img)
+    check_rows(store, 's2', 'h2', make_marks(3, 5), img)
+
+
+def test_busy_store(tmp_path, img, monkeypatch):
+    monkeypatch.setattr(FingerprintStore,
+                        '_FingerprintStore__LOCK_TIMEOUT_SEC', 0.05)
+    store = FingerprintStore(tmp_path)
+    (tmp_path / fingerprintstore.LOCK_FILE).touch()
+    assert not store.update('s1', 'h1', make_marks(1), img)
+    assert store.label_hash('s1') is None
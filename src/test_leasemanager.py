@@ -0,0 +1,78 @@
+"""Tests for LeaseManager and save conflicts of DatasetManager."""
+
+import os
+import time
+import shutil
+import pathlib
+from leasemanager import LeaseManager
+from datasetmanager import DatasetManager
+
+TEST_DS_PATH = pathlib.Path(__file__).parent / 'cars_ds_test'
+
+
+def test_claim_is_exclusive(tmp_path):
+    lm_a = LeaseManager(tmp_path, 'a')
+    lm_b = LeaseManager(tmp_path, 'b')
+    assert lm_a.claim(['s1', 's2'], 1) == ['s1']
+    assert lm_b.claim(['s1', 's2'], 2) == ['s2']
+    assert lm_a.holder('s1') == 'a'
+    assert lm_b.is_leased_by_other('s1')
+    assert not lm_a.is_leased_by_other('s1')
+
+
+def test_takeover_of_expired_lease(tmp_path):
+    lm_a = LeaseManager(tmp_path, 'a', expiry=0.05)
+    lm_b = LeaseManager(tmp_path, 'b')
+    assert lm_a.claim(['s1'], 1) == ['s1']
+    assert lm_b.claim(['s1'], 1) == []
+    time.sleep(0.1)
+    assert lm_b.claim(['s1'], 1) == ['s1']
+    lm_a.heartbeat()  # must not overwrite lease taken over by b
+    assert lm_a.owned_stems() == []
+    assert lm_a.holder('s1') == 'b'
+
+
+def test_takeover_of_empty_lease(tmp_path):
+    lm = LeaseManager(tmp_path, 'a', expiry=10)
+    path = tmp_path / 's1.lock'
+    path.touch()  # session was killed before lease was written
+    assert lm.claim(['s1'], 1) == []
+    assert lm.is_leased_by_other('s1')
+    old_time = time.time() - 20
+    os.utime(path, (old_time, old_time))
+    assert not lm.is_leased_by_other('s1')
+    assert lm.claim(['s1'], 1) == ['s1']
+    assert lm.holder('s1') == 'a'
+
+
+def test_heartbeat_prolongs_lease(tmp_path):
+    lm_a = LeaseManager(tmp_path, 'a', expiry=0.2)
+    lm_b = LeaseManager(tmp_path, 'b')
+    lm_a.claim(['s1'], 1)
+    for _ in range(3):
+        time.sleep(0.1)
+        lm_a.heartbeat()
+    assert lm_b.claim(['s1'], 1) == []
+    assert lm_a.owned_stems() == ['s1']
+    lm_a.release_all()
+    assert lm_a.holder('s1') is None
+
+
+def test_save_conflict_with_lease_of_other_session(tmp_path):
+    ds_path = tmp_path / 'ds'
+    shutil.copytree(TEST_DS_PATH, ds_path)
+    ds_a = DatasetManager(ds_path, 'a')
+    ds_b = DatasetManager(ds_path, 'b')
+    assert ds_a.move_to_first_unmarked()
+    name = ds_a.get_current()[0]
+    while ds_b.get_current()[0] != name:
+        assert ds_b.move_forward()
+    label = {'filename': name, 'img_width': 224, 'img_height': 224,
+             'marks': []}
+    assert ds_b.has_save_conflict()
+    assert not ds_b.save_marks_in_label(label)
+    assert not (ds_path / 'labels' / (name[:-4] + '.json')).exists()
+    assert ds_b.save_marks_in_label(label, force=True)
+    assert (ds_path / 'labels' / (name[:-4] + '.json')).exists()
+    ds_a.close()
+    ds_b.close()
@@ -0,0 +1,53 @@
+"""Tests for packed fragment dataset."""
+
+import numpy as np
+from mark import Mark
+import packedfragments
+from packedfragments import PackedFragmentWriter, PackedFragmentReader
+
+FW = 10
+
+
+def make_chunk(num, first=0):
+    fragms = [np.full((FW, FW, 3), first + k, dtype=np.uint8)
+              for k in range(num)]
+    marks = [Mark(5, 5, 6, 8, first + k) for k in range(num)]
+    sources = ['{}.jpg'.format((first + k) // 2) for k in range(num)]
+    return fragms, marks, sources
+
+
+def test_reopen_and_append(tmp_path):
+    writer = PackedFragmentWriter(tmp_path, FW)
+    writer.append(*make_chunk(3))
+    writer = PackedFragmentWriter(tmp_path, FW)
+    assert writer.count() == 3
+    writer.append(*make_chunk(3, first=3))
+
+    reader = PackedFragmentReader(tmp_path)
+    assert len(reader) == 6
+    assert reader.names == ['0.jpg', '1.jpg', '2.jpg']
+    for k in range(6):
+        fragm, mark = reader[k]
+        assert (fragm == k).all()
+        assert mark[4] == k
+        assert reader.get_mark(k).r == k
+        assert reader.get_source(k) == '{}.jpg'.format(k // 2)
+
+
+def test_interrupted_append_is_truncated(tmp_path):
+    writer = PackedFragmentWriter(tmp_path, FW)
+    writer.append(*make_chunk(2))
+    # tails of chunk, which was written without index (session was killed)
+    for name in [packedfragments.FRAGMENTS_FILE, packedfragments.MARKS_FILE,
+                 packedfragments.SOURCES_FILE, packedfragments.NAMES_FILE]:
+        with open(tmp_path / name, mode='ab') as file:
+            file.write(b'\x07' * 5)
+    assert len(PackedFragmentReader(tmp_path)) == 2
+
+    writer = PackedFragmentWriter(tmp_path, FW)
+    writer.append(*make_chunk(2, first=2))
+    reader = PackedFragmentReader(tmp_path)
+    assert len(reader) == 4
+    assert (reader[3][0] == 3).all()
+    assert reader.names == ['0.jpg', '1.jpg']
+    assert reader.get_source(3) == '1.jpg'
@@ -2,7 +2,6 @@
 
 import math
 import numpy as np
-import cv2 as cv
 
 
 def create_rotation_xf(rotation):
@@ -61,11 +60,19 @@ def find_matches(img, fragm, threshold):
     """Find matches of fragm in bi image.
     
     Return coincedences as list of rects.
+    img and fragm can be RGB(A) or already greyscale (2d arrays).
     """
-    fr_rgb = np.array(fragm, dtype=np.uint8)
-    img_rgb = np.array(img, dtype=np.uint8)
-    fr_grey = cv.cvtColor(fr_rgb, cv.COLOR_RGB2GRAY)
-    img_grey = cv.cvtColor(img_rgb, cv.COLOR_RGB2GRAY)
+    import cv2 as cv  # pylint: disable=import-outside-toplevel
+    # cv2 is imported here, because its import is slow and
+    # it isn't needed before the first frame is shown
+
+    def to_grey(x):
+        arr = np.asarray(x, dtype=np.uint8)
+        if arr.ndim == 2:
+            return np.ascontiguousarray(arr)
+        return cv.cvtColor(arr, cv.COLOR_RGB2GRAY)
+    fr_grey = to_grey(fragm)
+    img_grey = to_grey(img)
     res = cv.matchTemplate(img_grey, fr_grey, cv.TM_CCOEFF_NORMED)
     h, w = fr_grey.shape
     locs = np.where(res >= threshold)
@@ -0,0 +1,204 @@
+"""Module for Viewport class."""
+
+import math
+import collections
+import numpy as np
+from PIL import Image
+
+
+class Viewport():
+    """Class for zoomable and pannable view on image of any size.
+
+    Viewport shows part of source image at one of discrete zoom levels:
+    zoom = fit_zoom * ZOOM_STEP ** level, where fit_zoom fits whole image in
+    view. Every level is split in square tiles, which are scaled from source
+    image lazily and kept in LRU-cache, so only visible tiles are ever
+    resampled and panning reuses already scaled ones.
+
+    Coordinates:
+    - source - pixels of source image (marks are kept in it);
+    - view - pixels of rendered viewport image;
+    View offset is the position of view's top-left corner on current level.
+    """
+
+    __TILE_SZ = 256
+    __CACHE_SZ = 128
+    __ZOOM_STEP = 1.25
+    __MAX_ZOOM = 16
+
+    __view_size = (0, 0)
+    __img = None
+    __fit_zoom = 1
+    __level = 0
+    __max_level = 0
+    __offset = (0, 0)
+    __tiles = None
+
+    def __init__(self, view_size):
+        """."""
+        self.__view_size = view_size
+        self.__tiles = collections.OrderedDict()
+
+    def reset(self, img, keep_view=False):
+        """Set new source image and show it whole.
+
+        If keep_view is True and new image has the same size as previous,
+        it's considered as reloading of the same image: zoom, offset and
+        already scaled tiles are kept.
+        """
+        same_size = (self.__img is not None and img is not None
+                     and self.__img.size == img.size)
+        self.__img = img
+        if keep_view and same_size:
+            return
+        self.__tiles.clear()
+        if img is None:
+            return
+        vw, vh = self.__view_size
+        self.__fit_zoom = min(vw / img.width, vh / img.height)
+        ratio = max(self.__MAX_ZOOM / self.__fit_zoom, 1)
+        # small epsilon: log of exact power of ZOOM_STEP isn't exact
+        self.__max_level = int(math.floor(
+            math.log(ratio, self.__ZOOM_STEP) + 1e-9))
+        self.zoom_to_fit()
+
+    def zoom(self):
+        """Return current scale: view pixels per one source pixel."""
+        return self.__fit_zoom * self.__ZOOM_STEP ** self.__level
+
+    def __level_size(self):
+        z = self.zoom()
+        return (int(round(self.__img.width * z)),
+                int(round(self.__img.height * z)))
+
+    def __clamp_offset(self, offset):
+        res = []
+        for o, lsz, vsz in zip(offset, self.__level_size(), self.__view_size):
+            if lsz <= vsz:
+                res.append(-((vsz - lsz) // 2))
+            else:
+                res.append(int(min(max(o, 0), lsz - vsz)))
+        return tuple(res)
+
+    def zoom_to_fit(self):
+        """."""
+        if self.__img is None:
+            return False
+        old = (self.__level, self.__offset)
+        self.__level = 0
+        self.__offset = self.__clamp_offset((0, 0))
+        return (self.__level, self.__offset) != old
+
+    def __set_level(self, level, anchor):
+        if self.__img is None:
+            return False
+        level = min(max(level, 0), self.__max_level)
+        if level == self.__level:
+            return False
+        if anchor is None:
+            anchor = (self.__view_size[0] / 2, self.__view_size[1] / 2)
+        src_pt = self.view_to_source(anchor)
+        self.__level = level
+        z = self.zoom()
+        self.__offset = self.__clamp_offset((src_pt[0] * z - anchor[0],
+                                             src_pt[1] * z - anchor[1]))
+        return True
+
+    def zoom_in(self, anchor=None):
+        """Zoom in keeping anchor (point in view) at the same place."""
+        return self.__set_level(self.__level + 1, anchor)
+
+    def zoom_out(self, anchor=None):
+        """Zoom out keeping anchor (point in view) at the same place."""
+        return self.__set_level(self.__level - 1, anchor)
+
+    def pan(self, dx, dy):
+        """Shift view by (dx, dy) view pixels."""
+        if self.__img is None:
+            return False
+        old = self.__offset
+        self.__offset = self.__clamp_offset((old[0] + dx, old[1] + dy))
+        return self.__offset != old
+
+    def ensure_visible(self, src_pt, margin=0):
+        """Pan view so that src_pt (with margin in view pixels) is visible."""
+        if self.__img is None:
+            return False
+        vx, vy = self.source_to_view(src_pt)
+        dx, dy = 0, 0
+        vw, vh = self.__view_size
+        if vx < margin:
+            dx = vx - margin
+        elif vx > vw - margin:
+            dx = vx - (vw - margin)
+        if vy < margin:
+            dy = vy - margin
+        elif vy > vh - margin:
+            dy = vy - (vh - margin)
+        if dx == 0 and dy == 0:
+            return False
+        return self.pan(int(math.floor(dx)), int(math.floor(dy)))
+
+    def source_to_view(self, pt):
+        """."""
+        z = self.zoom()
+        return (pt[0] * z - self.__offset[0], pt[1] * z - self.__offset[1])
+
+    def view_to_source(self, pt):
+        """."""
+        z = self.zoom()
+        ox, oy = self.__offset
+        return ((pt[0] + ox) / z, (pt[1] + oy) / z)
+
+    def source_to_view_xf(self, scale=1):
+        """Make transform matrix from source to (optionally scaled) view."""
+        # utils.create_scale_xf scales homogeneous coordinate too,
+        # so matrix is built here explicitly to keep it affine
+        a = self.zoom() * scale
+        ox, oy = self.__offset
+        return np.array([[a, 0, -ox * scale],
+                         [0, a, -oy * scale],
+                         [0, 0, 1]])
+
+    def visible_source_rect(self):
+        """Return part of source image, which is in view, as rect."""
+        x0, y0 = self.view_to_source((0, 0))
+        x1, y1 = self.view_to_source(self.__view_size)
+        return [x0, y0, x1, y1]
+
+    def __get_tile(self, tx, ty):
+        key = (self.__level, tx, ty)
+        tile = self.__tiles.get(key)
+        if tile is not None:
+            self.__tiles.move_to_end(key)
+            return tile
+        T = self.__TILE_SZ
+        lw, lh = self.__level_size()
+        rect = [tx * T, ty * T, min((tx + 1) * T, lw), min((ty + 1) * T, lh)]
+        z = self.zoom()
+        box = (rect[0] / z, rect[1] / z,
+               min(rect[2] / z, self.__img.width),
+               min(rect[3] / z, self.__img.height))
+        size = (rect[2] - rect[0], rect[3] - rect[1])
+        tile = self.__img.resize(size, Image.BICUBIC, box=box)
+        self.__tiles[key] = tile
+        if len(self.__tiles) > self.__CACHE_SZ:
+            self.__tiles.popitem(last=False)
+        return tile
+
+    def render(self):
+        """Return RGBA-image of view, composed of visible tiles only."""
+        view = Image.new('RGBA', self.__view_size, color='white')
+        if self.__img is None:
+            return view
+        T = self.__TILE_SZ
+        lw, lh = self.__level_size()
+        ox, oy = self.__offset
+        vw, vh = self.__view_size
+        tx_range = range(max(ox, 0) // T, (min(ox + vw, lw) - 1) // T + 1)
+        ty_range = range(max(oy, 0) // T, (min(oy + vh, lh) - 1) // T + 1)
+        for ty in ty_range:
+            for tx in tx_range:
+                tile = self.__get_tile(tx, ty)
+                view.paste(tile, (tx * T - ox, ty * T - oy))
+        return view